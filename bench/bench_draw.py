@@ -0,0 +1,94 @@
+"""
+Бенчмарк solve_draw на разреженных и плотных ограничениях.
+
+    python bench/bench_draw.py [--repeat 3] [--only dense]
+
+Для каждого сценария печатает число участников, долю запретов и лучшее /
+худшее время из --repeat прогонов. Каждый результат проверяется:
+никто не дарит себе, запрещённым получателям и своей команде.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "santa-bench.log"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def couples(n):
+    users = [str(i) for i in range(n)]
+    exclusions = {}
+    for i in range(0, n - 1, 2):
+        exclusions[users[i]] = {users[i + 1]}
+        exclusions[users[i + 1]] = {users[i]}
+    return users, exclusions, {}
+
+
+def departments(n, count=2):
+    users, exclusions, _ = couples(n)
+    return users, exclusions, {u: f"dep{i % count}" for i, u in enumerate(users)}
+
+
+def half_team(n):
+    # Самый тесный выполнимый случай для команд: ровно половина в одной команде
+    users = [str(i) for i in range(n)]
+    return users, {}, {u: "team" for u in users[:n // 2]}
+
+
+def random_exclusions(n, density):
+    users = [str(i) for i in range(n)]
+    rnd = random.Random(n)
+    k = int((n - 1) * density)
+    exclusions = {u: set(rnd.sample(users, k)) - {u} for u in users}
+    return users, exclusions, {}
+
+
+SCENARIOS = {
+    'sparse': [
+        ("5000 пары", lambda: couples(5000)),
+        ("5000 два отдела + пары", lambda: departments(5000, 2)),
+        ("5000 десять отделов + пары", lambda: departments(5000, 10)),
+        ("5000 запреты 1%", lambda: random_exclusions(5000, 0.01)),
+    ],
+    'dense': [
+        ("5000 одна команда n/2", lambda: half_team(5000)),
+        ("5000 запреты 50%", lambda: random_exclusions(5000, 0.5)),
+        ("2000 запреты 90%", lambda: random_exclusions(2000, 0.9)),
+    ],
+}
+
+
+def check(users, exclusions, groups, pairs):
+    assert sorted(pairs) == sorted(users) and sorted(pairs.values()) == sorted(users)
+    for giver, receiver in pairs.items():
+        assert giver != receiver
+        assert receiver not in exclusions.get(giver, ())
+        assert groups.get(giver) is None or groups.get(giver) != groups.get(receiver)
+
+
+def run(kinds, repeat):
+    print(f"{'сценарий':<32}{'min, с':>10}{'max, с':>10}")
+    for kind in kinds:
+        for name, build in SCENARIOS[kind]:
+            users, exclusions, groups = build()
+            times = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                pairs = main.solve_draw(users, exclusions, groups)
+                times.append(time.perf_counter() - started)
+                check(users, exclusions, groups, pairs)
+            print(f"{name:<32}{min(times):>10.3f}{max(times):>10.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', choices=sorted(SCENARIOS))
+    args = parser.parse_args()
+    run([args.only] if args.only else ['sparse', 'dense'], args.repeat)
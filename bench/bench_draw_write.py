@@ -0,0 +1,83 @@
+"""
+Время do_draw с записью пар и outbox: 10, 1k и 50k участников, до и после.
+
+    python bench/bench_draw_write.py [--sizes 10,1000,50000] [--repeat 3]
+
+«После» — настоящий do_draw: пары в памяти, затем одна транзакция с
+executemany для target_id и outbox. «До» — построчная схема исходного
+do_draw на той же базе: UPDATE на каждого дарителя, SELECT ника и желания
+получателя на каждого и INSERT уведомления на каждого, тоже в одной
+транзакции. Подбор пар в обоих вариантах один и тот же (solve_draw),
+Telegram заменён заглушкой, а рассылка не запускается — меряется только
+путь до постановки уведомлений в очередь.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "santa-bench.log"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(prefix="santa-bench-"), "santa.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+async def fake_request(bot, method, timeout=None):
+    return True
+
+
+async def legacy_draw(chat_id):
+    players = await main.storage.fetchall('SELECT user_id FROM players WHERE chat_id = ?', (chat_id,))
+    user_ids = [p['user_id'] for p in players]
+    assignment = await asyncio.get_running_loop().run_in_executor(None, main.solve_draw, user_ids)
+
+    def assign(db):
+        for giver, receiver in assignment.items():
+            db.execute('UPDATE players SET target_id = ? WHERE user_id = ? AND chat_id = ?', (receiver, giver, chat_id))
+        db.execute("DELETE FROM outbox WHERE kind = 'draw' AND chat_id = ? AND status = 'pending'", (chat_id,))
+        for giver, receiver in assignment.items():
+            target = db.execute(
+                'SELECT nick, gift FROM players WHERE user_id = ? AND chat_id = ?', (receiver, chat_id)
+            ).fetchone()
+            db.execute(
+                "INSERT INTO outbox (kind, chat_id, recipient, text) VALUES ('draw', ?, ?, ?)",
+                (chat_id, giver, main.format_draw_message(target['nick'], target['gift']))
+            )
+    await main.storage.run(assign)
+
+
+async def timed(draw, chat_id, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await draw(chat_id)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+async def run(sizes, repeat):
+    main.bot.session.make_request = fake_request
+    main.broadcaster.submit = lambda rows: None
+    await main.init_db()
+    print(f"{'участников':>11}{'до, с':>10}{'после, с':>10}{'ускорение':>11}")
+    for size in sizes:
+        chat_id = f"-{size}"
+        await main.storage.execute("INSERT INTO games (chat_id) VALUES (?)", (chat_id,))
+        await main.register_users(chat_id, [(f"{size}{i}", f"User {i}") for i in range(size)])
+        before = await timed(legacy_draw, chat_id, repeat)
+        after = await timed(main.do_draw, chat_id, repeat)
+        print(f"{size:>11}{before:>10.3f}{after:>10.3f}{before / after:>10.2f}x", flush=True)
+    await main.storage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=lambda s: [int(n) for n in s.split(',')], default=[10, 1000, 50000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.repeat))
@@ -0,0 +1,77 @@
+"""
+Задержка get/set FSM: MemoryStorage aiogram против SQLiteFSMStorage.
+
+    python bench/bench_fsm.py [--keys 1000] [--ops 20000]
+
+SQLiteFSMStorage меряется с LRU-кэшем и без него (cache_ttl=0, как при
+нескольких процессах на одних чатах). Печатает p50/p99 в микросекундах
+для get_state, set_state, get_data и update_data по случайным ключам.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "santa-bench.log"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+
+import main  # noqa: E402
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def measure(storage, keys, ops):
+    timings = {'get_state': [], 'set_state': [], 'get_data': [], 'update_data': []}
+    rnd = random.Random(1)
+    for key in keys:
+        await storage.set_state(key, "SetupState:choosing_theme")
+    for i in range(ops):
+        key = rnd.choice(keys)
+        op = rnd.choice(list(timings))
+        started = time.perf_counter()
+        if op == 'get_state':
+            await storage.get_state(key)
+        elif op == 'set_state':
+            await storage.set_state(key, "SetupState:choosing_draw_time")
+        elif op == 'get_data':
+            await storage.get_data(key)
+        else:
+            await storage.update_data(key, {"theme": "christmas", "step": i})
+        timings[op].append((time.perf_counter() - started) * 1e6)
+    return timings
+
+
+async def run(key_count, ops):
+    keys = [StorageKey(bot_id=1, chat_id=-i, user_id=i) for i in range(key_count)]
+    db = main.Storage(os.path.join(tempfile.mkdtemp(prefix="santa-bench-"), "fsm.db"))
+    db.open()
+    await db.run(main._apply_migrations)
+    storages = [
+        ("MemoryStorage", MemoryStorage()),
+        ("SQLite + LRU", main.SQLiteFSMStorage(db, cache_size=key_count * 2, cache_ttl=30)),
+        ("SQLite без кэша", main.SQLiteFSMStorage(db, cache_ttl=0)),
+    ]
+    print(f"{'хранилище':<18}{'операция':<13}{'p50, мкс':>10}{'p99, мкс':>10}")
+    for name, storage in storages:
+        timings = await measure(storage, keys, ops)
+        for op, values in timings.items():
+            print(f"{name:<18}{op:<13}{percentile(values, 0.5):>10.1f}{percentile(values, 0.99):>10.1f}")
+    await db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--ops', type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(run(args.keys, args.ops))
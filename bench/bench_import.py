@@ -0,0 +1,74 @@
+"""
+Пропускная способность массовой регистрации (/import) на 10k участников.
+
+    python bench/bench_import.py [--users 10000] [--batches 1]
+
+Сравнивает регистрацию по одному (register_user — как при нажатии
+«Участвовать» или первом сообщении) с разбором CSV и register_users
+одной транзакцией. --batches делит ростер на несколько /import подряд:
+поздние пачки идут в уже заполненный чат. Печатает время и участников
+в секунду; каждый прогон идёт в свой чат, ники проверяются на уникальность.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "santa-bench.log"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(prefix="santa-bench-"), "santa.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def roster_csv(count, first_id):
+    return "user_id,name\n" + "".join(f"{first_id + i},Участник {i}\n" for i in range(count))
+
+
+async def one_by_one(chat_id, count):
+    for i in range(count):
+        await main.register_user(str(10 ** 9 + i), chat_id, f"Участник {i}")
+
+
+async def bulk(chat_id, count, batches):
+    size = -(-count // batches)
+    for start in range(0, count, size):
+        users, _ = main.parse_roster_csv(roster_csv(min(size, count - start), 10 ** 9 + start))
+        await main.register_users(chat_id, users)
+
+
+async def check(chat_id, count):
+    row = await main.storage.fetchone(
+        "SELECT count(*), count(DISTINCT nick) FROM players WHERE chat_id = ?", (chat_id,)
+    )
+    assert tuple(row) == (count, count), tuple(row)
+
+
+async def run(count, batches):
+    await main.init_db()
+    print(f"{'способ':<28}{'время, с':>10}{'участн./с':>12}")
+    runs = [
+        ("по одному (register_user)", lambda chat_id: one_by_one(chat_id, count)),
+        (f"CSV + register_users ×{batches}", lambda chat_id: bulk(chat_id, count, batches)),
+    ]
+    for i, (name, register) in enumerate(runs):
+        chat_id = f"-{i + 1}"
+        await main.storage.execute("INSERT INTO games (chat_id) VALUES (?)", (chat_id,))
+        started = time.perf_counter()
+        await register(chat_id)
+        elapsed = time.perf_counter() - started
+        await check(chat_id, count)
+        print(f"{name:<28}{elapsed:>10.3f}{count / elapsed:>12.0f}", flush=True)
+    await main.storage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--batches', type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.batches))
@@ -0,0 +1,116 @@
+"""
+Масштабирование шардированного режима: апдейты в секунду на 1 → N воркерах.
+
+    python bench/bench_shards.py [--shards 1,2,4] [--chats 500] [--updates 20000] [--latency 0.02]
+
+Для каждого N бот запускается как `main.py --shards N` (фронт + N
+процессов-воркеров) против bench/fake_bot_api.py. Нагрузка — нажатия
+«Участвовать» в --chats группах, каждое от нового игрока: регистрация с
+записью в базу и ответ на callback. Сначала по одному нажатию на чат
+прогревает воркеры, затем замеряется основная пачка. Печатает апдейты в
+секунду и ускорение относительно первого N. Рост виден, только пока ядер
+хватает на фронт и все воркеры: на одном ядре процессы делят его между собой.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from scenarios import button_press, group  # noqa: E402
+
+FIRST_CHAT_ID = -1002000000000
+
+
+def presses(main, chats, count, first_user):
+    data = main.pack_callback(main.CB_JOIN)
+    return [
+        button_press(first_user + i, data, first_user + i, group(FIRST_CHAT_ID - i % chats))
+        for i in range(count)
+    ]
+
+
+async def wait_answers(api, expected, timeout):
+    deadline = time.perf_counter() + timeout
+    while api.calls["answerCallbackQuery"] < expected:
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"обработано {api.calls['answerCallbackQuery']} из {expected} нажатий")
+        await asyncio.sleep(0.01)
+
+
+async def run_one(args):
+    api = FakeBotAPI(latency=args.latency)
+    url = await api.start()
+    workdir = tempfile.mkdtemp(prefix="santa-shards-")
+    # Воркеры запускаются через spawn и наследуют это окружение
+    os.environ.update({
+        "TELEGRAM_API_URL": url,
+        "BOT_TOKEN": "123456:SHARDBENCH",
+        "DB_NAME": os.path.join(workdir, "santa.db"),
+        "LOG_FILE": os.path.join(workdir, "bot.log"),
+        # Меряем обработку, а не отбрасывание: нажатия «Участвовать» без лимитов
+        "THROTTLE_LIMITS": "join:1000000:1000000:1000000:1000000",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import main
+
+    await main.init_db()
+    await main.storage.executemany(
+        "INSERT INTO games (chat_id, lang, theme) VALUES (?, 'ru', 'christmas')",
+        [(str(FIRST_CHAT_ID - i),) for i in range(args.chats)]
+    )
+    await main.storage.close()
+
+    front = asyncio.create_task(main.run_sharded(args.one))
+    try:
+        api.push(presses(main, args.chats, args.chats, first_user=1))
+        await wait_answers(api, args.chats, args.timeout)
+        started = time.perf_counter()
+        api.push(presses(main, args.chats, args.updates, first_user=args.chats + 1))
+        await wait_answers(api, args.chats + args.updates, args.timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        front.cancel()
+        await asyncio.gather(front, return_exceptions=True)
+        await api.stop()
+    # Родительский процесс читает «время скорость» из stdout
+    print(elapsed, args.updates / elapsed)
+
+
+def run(args):
+    print(f"ядер: {os.cpu_count()}, чатов: {args.chats}, нажатий: {args.updates}")
+    print(f"{'шарды':>6}{'время, с':>10}{'апд/с':>10}{'ускорение':>11}", flush=True)
+    baseline = None
+    for shards in args.shards:
+        command = [sys.executable, os.path.abspath(__file__), '--one', str(shards),
+                   '--chats', str(args.chats), '--updates', str(args.updates),
+                   '--latency', str(args.latency), '--timeout', str(args.timeout)]
+        result = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        if result.returncode:
+            sys.exit(1)
+        elapsed, rate = map(float, result.stdout.split())
+        baseline = baseline or rate
+        print(f"{shards:>6}{elapsed:>10.2f}{rate:>10.0f}{rate / baseline:>10.2f}x", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--shards', type=lambda s: [int(n) for n in s.split(',')], default=[1, 2, 4])
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.02, help="задержка ответа Bot API, с")
+    parser.add_argument('--timeout', type=float, default=600.0)
+    # Внутренний флаг: один прогон с заданным числом шардов в отдельном процессе
+    parser.add_argument('--one', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.one:
+        asyncio.run(run_one(args))
+    else:
+        run(args)
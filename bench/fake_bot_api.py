@@ -0,0 +1,165 @@
+"""
+Заглушка Bot API на aiohttp для нагрузочных прогонов без настоящего Telegram.
+
+Бот направляется на неё через TELEGRAM_API_URL=http://127.0.0.1:<port>.
+Реализованы getUpdates (long polling из очереди сценария), sendMessage,
+editMessageText, answerCallbackQuery, getChatMember, sendInvoice и
+служебные вызовы, которые бот делает при старте. У каждого ответа
+настраиваемая задержка, а у методов из rate_limited с вероятностью
+rate_limit_ratio вместо ответа приходит 429 с retry_after.
+
+Можно запустить отдельно:
+
+    python bench/fake_bot_api.py --port 8081 --latency 0.02 --rate-limit 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Santa", "username": "santa_bench_bot"}
+
+
+class FakeBotAPI:
+    """Состояние заглушки: очередь апдейтов, счётчики вызовов и инъекция ошибок"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit_ratio: float = 0.0,
+                 retry_after: int = 1, rate_limited=("sendMessage", "editMessageText", "answerCallbackQuery"),
+                 seed: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.rate_limited = set(rate_limited)
+        self.calls: Counter = Counter()
+        self.rate_limited_calls: Counter = Counter()
+        self.served_updates = 0
+        self._random = random.Random(seed)
+        self._updates: List[Dict[str, Any]] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self._new_updates: Optional[asyncio.Event] = None
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    # --- очередь апдейтов ---
+    def push(self, updates: List[Dict[str, Any]]):
+        """Ставит апдейты в очередь getUpdates, проставляя update_id по порядку"""
+        for update in updates:
+            update["update_id"] = next(self._update_ids)
+            self._updates.append(update)
+        if self._new_updates is not None:
+            self._new_updates.set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._updates)
+
+    # --- ответы ---
+    def _message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params.get("chat_id", 0))
+        chat = {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private", "title": "bench"}
+        message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat,
+                   "from": BOT_USER, "text": params.get("text", "")}
+        if "reply_markup" in params:
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        return message
+
+    async def _get_updates(self, params: Dict[str, Any]):
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        # Подтверждённые апдейты (id < offset) больше не отдаём
+        if offset:
+            drop = 0
+            while drop < len(self._updates) and self._updates[drop]["update_id"] < offset:
+                drop += 1
+            del self._updates[:drop]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = self._updates[:limit]
+        self.served_updates += len(batch)
+        return batch
+
+    def _result(self, method: str, params: Dict[str, Any]) -> Any:
+        if method in ("sendMessage", "sendInvoice"):
+            return self._message(params)
+        if method == "editMessageText":
+            return self._message(params) if "chat_id" in params else True
+        if method == "getMe":
+            return BOT_USER
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "getChatMember":
+            user = {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "u"}
+            return {"status": "member", "user": user}
+        if method == "getChatAdministrators":
+            return [{"status": "creator", "is_anonymous": False,
+                     "user": {"id": 1, "is_bot": False, "first_name": "admin"}}]
+        # answerCallbackQuery, setMyCommands, deleteWebhook, answerPreCheckoutQuery и т.п.
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._random.random() * self.jitter)
+        if method in self.rate_limited and self._random.random() < self.rate_limit_ratio:
+            self.rate_limited_calls[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    # --- сервер ---
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._new_updates = asyncio.Event()
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def _serve(args):
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, rate_limit_ratio=args.rate_limit)
+    print(f"Fake Bot API: {await api.start(args.host, args.port)}")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Заглушка Bot API")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="доля ответов 429")
+    asyncio.run(_serve(parser.parse_args()))
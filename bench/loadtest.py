@@ -0,0 +1,158 @@
+"""
+Нагрузочный прогон бота против заглушки Bot API.
+
+    python bench/loadtest.py --scenario mass_join
+    python bench/loadtest.py --scenario all --scale 0.2 --latency 0.02 --rate-limit 0.01
+
+Бот работает как в проде — polling через getUpdates, те же middleware и
+хендлеры, — только TELEGRAM_API_URL указывает на bench/fake_bot_api.py,
+а база и лог лежат во временном каталоге. Отчёт: p50/p99 времени
+обработки апдейта, апдейтов в секунду, транзакций и SQL-операторов базы
+на апдейт, вызовы Bot API и ответы 429. Каждый сценарий идёт в отдельном
+процессе, чтобы кэши одного не влияли на другой.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from scenarios import SCENARIOS  # noqa: E402
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class LatencyRecorder:
+    """Outer-middleware апдейтов: время от входа в диспетчер до конца обработки"""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.timings = []
+        self.done = asyncio.Event()
+        if not expected:
+            self.done.set()
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.timings.append(time.perf_counter() - started)
+            if len(self.timings) >= self.expected:
+                self.done.set()
+
+
+async def run_scenario(args) -> int:
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, rate_limit_ratio=args.rate_limit)
+    url = await api.start()
+    workdir = tempfile.mkdtemp(prefix="santa-load-")
+    # main читает окружение при импорте
+    os.environ.update({
+        "TELEGRAM_API_URL": url,
+        "BOT_TOKEN": "123456:LOADTEST",
+        "DB_NAME": os.path.join(workdir, "santa.db"),
+        "LOG_FILE": os.path.join(workdir, "bot.log"),
+        "DB_COUNT_STATEMENTS": "1",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import main
+
+    if args.no_throttle:
+        for scope in list(main.THROTTLE_LIMITS):
+            main.THROTTLE_LIMITS[scope] = (1e9, 10 ** 9, 1e9, 10 ** 9)
+
+    scenario = SCENARIOS[args.scenario](scale=args.scale)
+    await main.init_db()
+    await scenario.setup(main)
+    await main.warm_membership_index()
+    await main.broadcaster.start()
+    main.score_buffer.start()
+
+    updates = scenario.updates(main)
+    recorder = LatencyRecorder(len(updates))
+    main.dp.update.outer_middleware(recorder)
+    transactions, statements = main.storage.transactions, main.storage.statements
+
+    polling = asyncio.create_task(main.dp.start_polling(
+        main.bot, handle_signals=False, polling_timeout=1, allowed_updates=main.dp.resolve_used_update_types()
+    ))
+    started = time.perf_counter()
+    api.push(updates)
+    action_started = time.perf_counter()
+    note = await scenario.action(main)
+    action_seconds = time.perf_counter() - action_started
+    try:
+        await asyncio.wait_for(recorder.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ за {args.timeout} с обработано {len(recorder.timings)} из {len(updates)} апдейтов")
+    elapsed = time.perf_counter() - started
+    await main.score_buffer.flush()
+    transactions = main.storage.transactions - transactions
+    statements = main.storage.statements - statements
+
+    await main.dp.stop_polling()
+    await polling
+    await main.broadcaster.stop()
+    await main.score_buffer.stop()
+    await main.join_updater.stop()
+    await main.storage.close()
+    await api.stop()
+
+    processed = len(recorder.timings)
+    per_update = max(processed, 1)
+    ms = [t * 1000 for t in recorder.timings]
+    print(f"== {scenario.name}: {scenario.description}")
+    if updates:
+        print(f"апдейтов: {processed} за {elapsed:.2f} с — {processed / elapsed:.0f} апд/с")
+        print(f"обработка апдейта, мс: p50 {percentile(ms, 0.5):.2f}  p99 {percentile(ms, 0.99):.2f}  "
+              f"max {max(ms, default=0):.2f}")
+    if note is not None:
+        print(f"действие сценария: {action_seconds:.3f} с, {note}")
+    print(f"база: {transactions} транзакций, {statements} операторов"
+          + (f" — {transactions / per_update:.2f} и {statements / per_update:.2f} на апдейт" if updates else ""))
+    calls = ", ".join(f"{method} {count}" for method, count in api.calls.most_common() if method != "getUpdates")
+    print(f"Bot API: {calls or '—'}; 429: {sum(api.rate_limited_calls.values())}")
+    print(f"ограничение частоты: {main.throttling.stats['dropped'] or 'ничего не отброшено'}")
+    return 0 if processed >= len(updates) else 1
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против заглушки Bot API")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--scale', type=float, default=1.0, help="множитель размеров сценария")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="доля ответов 429 на send/edit/answer")
+    parser.add_argument('--no-throttle', action='store_true', help="снять ограничение частоты команд и кнопок")
+    parser.add_argument('--timeout', type=float, default=300.0, help="сколько ждать обработки всех апдейтов, с")
+    args = parser.parse_args()
+
+    if args.scenario != 'all':
+        sys.exit(asyncio.run(run_scenario(args)))
+
+    options = ['--scale', str(args.scale), '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--rate-limit', str(args.rate_limit), '--timeout', str(args.timeout)]
+    if args.no_throttle:
+        options.append('--no-throttle')
+    failed = 0
+    for name in SCENARIOS:
+        command = [sys.executable, os.path.abspath(__file__), '--scenario', name] + options
+        failed |= subprocess.run(command).returncode
+        print()
+    sys.exit(failed)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,120 @@
+"""
+Сценарии нагрузочных прогонов. Каждый сценарий готовит базу (setup),
+отдаёт список сырых апдейтов Telegram для getUpdates и, если нужно,
+действие вне апдейтов (action) — например, саму жеребьёвку.
+Размеры задаются через scale: 1.0 — размеры из названий сценариев.
+"""
+import random
+from typing import Any, Dict, List
+
+GROUP_ID = -1001000000001
+GROUP = {"id": GROUP_ID, "type": "supergroup", "title": "Bench"}
+# Сообщение бота с кнопками, на которое приходят нажатия
+BOT_MESSAGE_ID = 1
+
+
+def user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def text_message(user_id: int, text: str, message_id: int) -> Dict[str, Any]:
+    message = {"message_id": message_id, "date": 1, "chat": GROUP, "from": user(user_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+
+def group(chat_id: int) -> Dict[str, Any]:
+    return {"id": chat_id, "type": "supergroup", "title": f"Bench {chat_id}"}
+
+
+def button_press(user_id: int, data: str, query_id: int, chat: Dict[str, Any] = GROUP) -> Dict[str, Any]:
+    message = {"message_id": BOT_MESSAGE_ID, "date": 1, "chat": chat, "text": "…",
+               "from": {"id": 123456, "is_bot": True, "first_name": "Santa"}}
+    return {"callback_query": {"id": str(query_id), "from": user(user_id), "chat_instance": "bench",
+                               "message": message, "data": data}}
+
+
+async def create_game(main, players: int = 0):
+    await main.storage.execute(
+        "INSERT OR REPLACE INTO games (chat_id, lang, theme) VALUES (?, 'ru', 'christmas')", (str(GROUP_ID),)
+    )
+    if players:
+        await main.register_users(str(GROUP_ID), [(str(i), f"User{i}") for i in range(1, players + 1)])
+
+
+class Scenario:
+    name = ""
+    description = ""
+
+    def __init__(self, scale: float = 1.0, seed: int = 1):
+        self.scale = scale
+        self.random = random.Random(seed)
+
+    def size(self, base: int) -> int:
+        return max(int(base * self.scale), 2)
+
+    async def setup(self, main):
+        await create_game(main)
+
+    def updates(self, main) -> List[Dict[str, Any]]:
+        return []
+
+    async def action(self, main):
+        """Работа вне апдейтов; возвращает подпись для отчёта или None"""
+        return None
+
+
+class Chat10k(Scenario):
+    name = "chat_10k"
+    description = "группа из 10k участников переписывается, первое сообщение регистрирует автора"
+
+    def updates(self, main):
+        members = self.size(10000)
+        return [
+            text_message(self.random.randint(1, members), "всем привет 🎄", i)
+            for i in range(self.size(30000))
+        ]
+
+
+class MassJoin(Scenario):
+    name = "mass_join"
+    description = "5k человек жмут «Участвовать в игре» под одним сообщением"
+
+    def updates(self, main):
+        data = main.pack_callback(main.CB_JOIN)
+        return [button_press(user_id, data, user_id) for user_id in range(1, self.size(5000) + 1)]
+
+
+class Draw5k(Scenario):
+    name = "draw_5k"
+    description = "жеребьёвка на 5k участников: пары, outbox и постановка рассылки"
+
+    async def setup(self, main):
+        await create_game(main, players=self.size(5000))
+
+    async def action(self, main):
+        await main.do_draw(str(GROUP_ID))
+        queued = main.broadcaster.queue.qsize()
+        return f"в очереди рассылки {queued} сообщений"
+
+
+class GuessStorm(Scenario):
+    name = "guess_storm"
+    description = "2k игроков засыпают кнопки угадывания, примерно треть догадок верные"
+
+    async def setup(self, main):
+        await create_game(main, players=self.size(2000))
+
+    def updates(self, main):
+        players = self.size(2000)
+        updates = []
+        for i in range(self.size(20000)):
+            guesser = self.random.randint(1, players)
+            target = self.random.randint(1, players)
+            selected = target if self.random.random() < 0.33 else self.random.randint(1, players)
+            updates.append(button_press(guesser, main.pack_callback(main.CB_GUESS, target, selected), i))
+        return updates
+
+
+SCENARIOS = {cls.name: cls for cls in (Chat10k, MassJoin, Draw5k, GuessStorm)}
@@ -1,43 +1,178 @@
 # main.py
+import argparse
 import asyncio
 import logging
-import traceback
+import logging.handlers
+import atexit
+import gzip
+import shutil
 from typing import Optional, List, Dict, Any
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.types import (
     Message, InlineKeyboardButton, InlineKeyboardMarkup, 
-    PreCheckoutQuery, LabeledPrice, ChatMemberOwner, ChatMemberAdministrator, ErrorEvent
+    PreCheckoutQuery, LabeledPrice, ChatMemberOwner, ChatMemberAdministrator, ErrorEvent,
+    ChatMemberUpdated
 )
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject, Filter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.enums import ParseMode, ChatType
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import sqlite3
+import json
 import os
-from contextlib import contextmanager
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import math
 import random
+import heapq
+import csv
+import io
+from bisect import bisect_left
+import contextvars
+import base64
+import string
 import hashlib
+import zlib
+import multiprocessing
+import time
+from collections import OrderedDict
+from queue import SimpleQueue
 
 # === НАСТРОЙКИ ===
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN не установлен")
 
+# Адрес Bot API: свой сервер telegram-bot-api или локальная заглушка для нагрузочных прогонов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
 # Уникальный идентификатор экземпляра для предотвращения конфликтов
 INSTANCE_ID = f"santa_bot_{hashlib.md5(f'{BOT_TOKEN}{os.getpid()}{datetime.now().timestamp()}'.encode()).hexdigest()[:8]}"
 
 # === ЛОГИРОВАНИЕ ===
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+# Хендлеры ставят записи в очередь, а форматирование, запись в файл,
+# ротация и сжатие идут в потоке QueueListener, не блокируя event loop.
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")  # например "midnight" — ротация по времени вместо размера
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_CONTEXT_FIELDS = ('chat_id', 'user_id', 'handler')
+
+# Поля текущего апдейта (chat_id, user_id, handler), их выставляет LogContextMiddleware
+log_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default=None)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в потоке loop: только добавляет контекст апдейта"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        context = log_context.get()
+        if context:
+            for field, value in context.items():
+                if not hasattr(record, field):
+                    setattr(record, field, value)
+        return record
+
+class SampleFilter(logging.Filter):
+    """Пропускает долю rate записей уровня INFO и ниже; предупреждения и ошибки — всегда"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.INFO or random.random() < self.rate
+
+def _gzip_rotator(source: str, dest: str):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging(log_file: str = LOG_FILE):
+    """(Пере)настраивает логирование; шарды вызывают его со своим файлом"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding='utf-8', delay=True
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8', delay=True
+        )
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = _gzip_rotator
+    formatter = JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_LOG_FORMAT)
+    handlers = [file_handler, logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [ContextQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+
+def _stop_logging():
+    if _log_listener is not None:
+        _log_listener.stop()
+
+setup_logging()
+atexit.register(_stop_logging)
 logger = logging.getLogger(__name__)
+# Массовые события (авторегистрация) пишутся выборочно, см. LOG_SAMPLE_RATE
+activity_logger = logging.getLogger(f"{__name__}.activity")
+activity_logger.addFilter(SampleFilter(LOG_SAMPLE_RATE))
+# aiogram пишет строку INFO на каждый апдейт — её тоже выборочно
+logging.getLogger("aiogram.event").addFilter(SampleFilter(LOG_SAMPLE_RATE))
+
+class LogContextMiddleware(BaseMiddleware):
+    """Внутренний middleware: chat_id, user_id и имя хендлера для всех записей апдейта"""
+
+    async def __call__(self, handler, event, data):
+        chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+        user = getattr(event, 'from_user', None)
+        token = log_context.set({
+            'chat_id': chat.id if chat else None,
+            'user_id': user.id if user else None,
+            'handler': data['handler'].callback.__name__,
+        })
+        try:
+            return await handler(event, data)
+        finally:
+            log_context.reset(token)
 
 # === ПЕРЕВОДЫ ===
 TEXTS = {
@@ -55,6 +190,8 @@ TEXTS = {
                 "8. В день раскрытия — финал: таблица, ачивки, смех\n\n"
                 "🔹 /setup — настроить игру\n"
                 "🔹 /mygift — указать желание\n"
+                "🔹 /couple — ответом на сообщение: не дарить друг другу\n"
+                "🔹 /team — указать свою команду (отдел)\n"
                 "🔹 /santabingo — угадать личность\n"
                 "🔹 /leaderboard — таблица лидеров\n"
                 "🔹 /lang — сменить язык\n"
@@ -86,7 +223,14 @@ TEXTS = {
         'premium_sold': "🚫 Этот ник уже куплен другим участником.",
         'auto_register_call': "🎄 Игра в Тайного Санту настроена!\n\n👥 Участников: {count}\n\n🎮 Хотите участвовать? Нажмите кнопку ниже!",
         'joined_game': "✅ Вы присоединились к игре с ником {nick}!",
-        'already_joined': "ℹ️ Вы уже участвуете в игре."
+        'already_joined': "ℹ️ Вы уже участвуете в игре.",
+        'throttled': "⏳ Слишком часто, подождите немного.",
+        'couple_saved': "💞 Готово: в жеребьёвке вы не выпадете друг другу.",
+        'team_saved': "👥 Команда установлена: {team}. Внутри команды подарки не дарят, если хватает участников из других команд.",
+        'team_cleared': "👥 Команда сброшена.",
+        'import_usage': "📥 Массовая регистрация: отправьте /import подписью к CSV-файлу (строки вида user_id,имя), "
+                        "ответом на такой файл или на пересланное сообщение, либо с упоминаниями участников.",
+        'import_done': "📥 Зарегистрировано новых участников: {added}\nУже были в игре: {existing}\nНе распознано: {skipped}"
     },
     'en': {
         'start': "🎁 Hi! I'm a *Secret Santa* bot.\n\n"
@@ -102,6 +246,8 @@ TEXTS = {
                 "8. On reveal day — final: leaderboard, achievements, fun\n\n"
                 "🔹 /setup — configure game\n"
                 "🔹 /mygift — set wish\n"
+                "🔹 /couple — as a reply: don't draw each other\n"
+                "🔹 /team — set your team (department)\n"
                 "🔹 /santabingo — guess identity\n"
                 "🔹 /leaderboard — leaderboard\n"
                 "🔹 /lang — change language\n"
@@ -133,7 +279,14 @@ TEXTS = {
         'premium_sold': "🚫 This nick is already purchased by another player.",
         'auto_register_call': "🎄 Secret Santa game is set up!\n\n👥 Participants: {count}\n\n🎮 Want to participate? Click the button below!",
         'joined_game': "✅ You joined the game with nick {nick}!",
-        'already_joined': "ℹ️ You are already participating in the game."
+        'already_joined': "ℹ️ You are already participating in the game.",
+        'throttled': "⏳ Too fast, please wait a moment.",
+        'couple_saved': "💞 Done: you won't draw each other.",
+        'team_saved': "👥 Team set: {team}. Members of the same team don't gift each other when there are enough players outside it.",
+        'team_cleared': "👥 Team cleared.",
+        'import_usage': "📥 Bulk registration: send /import as the caption of a CSV file (rows like user_id,name), "
+                        "as a reply to such a file or to a forwarded message, or with member mentions.",
+        'import_done': "📥 New players registered: {added}\nAlready in the game: {existing}\nNot recognized: {skipped}"
     }
 }
 
@@ -151,55 +304,717 @@ PREMIUM_NICKS = {
     }
 }
 
-# === БАЗА ДАННЫХ ===
-DB_NAME = "santa.db"
-
-def init_db():
-    with get_db() as db:
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS games (
-                chat_id TEXT PRIMARY KEY,
-                lang TEXT DEFAULT 'ru',
-                theme TEXT DEFAULT 'christmas',
-                draw_time INTEGER,
-                end_time INTEGER
-            )
-        ''')
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS players (
-                user_id TEXT,
-                chat_id TEXT,
-                full_name TEXT,
-                nick TEXT,
-                gift TEXT,
-                score INTEGER DEFAULT 0,
-                target_id TEXT,
-                premium_nick TEXT,
-                PRIMARY KEY (user_id, chat_id)
-            )
-        ''')
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS achievements (
-                player_id TEXT,
-                name TEXT,
-                PRIMARY KEY (player_id, name)
-            )
-        ''')
-        db.commit()
+# === CALLBACK-ДАННЫЕ ===
+# callback_data — это байт вида кнопки и zigzag-varint числа в base64url:
+# кнопка угадывания с двумя 10-значными id занимает 15 символов вместо ~27,
+# а ники и темы передаются индексами в статических таблицах, поэтому
+# юникод и "_" в них не упираются в лимит 64 байта и не ломают разбор.
+CB_JOIN, CB_HELP, CB_THEME, CB_GUESS, CB_BINGO, CB_BUY = range(1, 7)
+CALLBACK_ARITY = {CB_JOIN: 0, CB_HELP: 0, CB_THEME: 1, CB_GUESS: 2, CB_BINGO: 2, CB_BUY: 1}
+THEMES = ('christmas', 'halloween', 'office')
+PREMIUM_NICK_TABLE = [nick for themes in PREMIUM_NICKS.values() for nicks in themes.values() for nick in nicks]
+PREMIUM_NICK_IDS = {nick: i for i, nick in reversed(list(enumerate(PREMIUM_NICK_TABLE)))}
 
-@contextmanager
-def get_db():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+def pack_callback(kind: int, *values: int) -> str:
+    out = bytearray((kind,))
+    for value in values:
+        value = (value << 1) ^ (value >> 63)  # zigzag: отрицательные числа тоже короткие
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return base64.urlsafe_b64encode(bytes(out)).rstrip(b"=").decode()
+
+def _unpack_legacy(data: str) -> Optional[tuple]:
+    """Строковые callback_data старых версий — кнопки уже разосланы по чатам"""
+    if data == "join_game":
+        return (CB_JOIN,)
+    if data == "help":
+        return (CB_HELP,)
+    kind, _, rest = data.partition("_")
+    if kind == "theme" and rest in THEMES:
+        return (CB_THEME, THEMES.index(rest))
+    if kind == "buy" and rest in PREMIUM_NICK_IDS:
+        return (CB_BUY, PREMIUM_NICK_IDS[rest])
+    if kind in ("guess", "bingo"):
+        first, _, second = rest.partition("_")
+        return (CB_GUESS if kind == "guess" else CB_BINGO, int(first), int(second))
+    return None
+
+def unpack_callback(data: str) -> Optional[tuple]:
+    """Возвращает (вид, *числа) или None для чужих и битых данных"""
     try:
-        yield conn
-        conn.commit()
-    except Exception as e:
-        print(f"DB Error: {e}")
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except ValueError:
+        raw = b""
+    if not raw or raw[0] not in CALLBACK_ARITY:
+        try:
+            return _unpack_legacy(data)
+        except ValueError:
+            return None
+    values = []
+    value = shift = 0
+    for byte in raw[1:]:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append((value >> 1) ^ -(value & 1))
+            value = shift = 0
+    if value or shift or len(values) != CALLBACK_ARITY[raw[0]]:
+        return None
+    return (raw[0], *values)
+
+class CallbackDataMiddleware(BaseMiddleware):
+    """Разбирает callback_data один раз на апдейт, фильтры берут готовый результат"""
+
+    async def __call__(self, handler, event, data):
+        data['cb'] = unpack_callback(event.data) if event.data else None
+        return await handler(event, data)
+
+class CallbackKind(Filter):
+    """Пропускает callback нужного вида и передаёт числа в хендлер как cb_args"""
+
+    def __init__(self, kind: int):
+        self.kind = kind
+
+    async def __call__(self, callback, cb: Optional[tuple] = None):
+        if cb is None or cb[0] != self.kind:
+            return False
+        return {'cb_args': cb[1:]}
+
+# === ШАРДЫ ===
+# Номер шарда текущего процесса и их общее число; в обычном режиме шард один
+SHARD_ID = 0
+SHARD_COUNT = 1
+
+def shard_of(chat_id, count: int) -> int:
+    """Стабильный между процессами номер шарда для чата (hash() от строки рандомизирован)"""
+    return zlib.crc32(str(chat_id).encode()) % count
+
+def owns_chat(chat_id) -> bool:
+    return SHARD_COUNT == 1 or shard_of(chat_id, SHARD_COUNT) == SHARD_ID
+
+# === МЕТРИКИ ===
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — сервер метрик не запускается
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600)
+
+class Metrics:
+    """
+    Минимальный реестр метрик в текстовом формате Prometheus: счётчики и
+    гистограммы с фиксированными бакетами. Запись — пара обращений к dict
+    и bisect, без блокировок (всё в одном event loop).
+    """
+
+    def __init__(self):
+        self._meta: Dict[str, tuple] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._histograms: Dict[tuple, list] = {}
+        self._buckets: Dict[str, tuple] = {}
+        self._collectors: list = []
+
+    def counter(self, name: str, help_text: str):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple):
+        self._meta[name] = ('histogram', help_text, buckets)
+        self._buckets[name] = buckets
+
+    def collector(self, fn):
+        """fn() -> [(имя, тип, описание, метки, значение)], вызывается при каждом запросе /metrics"""
+        self._collectors.append(fn)
+        return fn
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        key = (name, labels)
+        series = self._histograms.get(key)
+        buckets = self._buckets[name]
+        if series is None:
+            # счётчики бакетов (последний — +Inf), затем сумма и количество
+            series = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+        series[bisect_left(buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @staticmethod
+    def _escape(value) -> str:
+        # Экранирование значений меток по формату Prometheus
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{Metrics._escape(v)}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                lines.extend(
+                    f"{name}{self._labels(labels)} {value}"
+                    for (series_name, labels), value in self._counters.items() if series_name == name
+                )
+                continue
+            for (series_name, labels), series in self._histograms.items():
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*buckets, "+Inf"), series):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {series[-2]}")
+                lines.append(f"{name}_count{self._labels(labels)} {series[-1]}")
+        # Серии одной метрики в формате Prometheus должны идти подряд
+        families: Dict[str, list] = {}
+        for collect in self._collectors:
+            for name, kind, help_text, labels, value in collect():
+                family = families.setdefault(name, [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+                family.append(f"{name}{self._labels(labels)} {value}")
+        for family in families.values():
+            lines.extend(family)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.counter("santa_updates_total", "Апдейты по типу и исходу")
+metrics.histogram("santa_update_seconds", "Полное время обработки апдейта", LATENCY_BUCKETS)
+metrics.histogram("santa_handler_seconds", "Время работы хендлера", LATENCY_BUCKETS)
+metrics.histogram("santa_update_db_queries", "Запросов к базе на апдейт", COUNT_BUCKETS)
+metrics.histogram("santa_update_db_seconds", "Время ожидания базы на апдейт", LATENCY_BUCKETS)
+metrics.histogram("santa_api_seconds", "Задержка запросов к Bot API", LATENCY_BUCKETS)
+metrics.counter("santa_api_errors_total", "Ошибки Bot API (retry_after — это 429)")
+metrics.histogram("santa_job_lag_seconds", "Опоздание запуска жеребьёвки и раскрытия", LAG_BUCKETS)
+metrics.histogram("santa_job_seconds", "Длительность жеребьёвки и раскрытия", LAG_BUCKETS)
+
+# [число запросов, секунд в базе] текущего апдейта; Storage.run дописывает сюда
+db_usage: contextvars.ContextVar = contextvars.ContextVar("db_usage", default=None)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware на update: тип, исход, общее время и работа с базой"""
+
+    async def __call__(self, handler, event, data):
+        usage = [0, 0.0]
+        token = db_usage.set(usage)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await handler(event, data)
+            outcome = 'unhandled' if result is UNHANDLED else 'handled'
+            return result
+        finally:
+            db_usage.reset(token)
+            labels = (('type', event.event_type),)
+            metrics.inc("santa_updates_total", (labels[0], ('outcome', outcome)))
+            metrics.observe("santa_update_seconds", labels, time.perf_counter() - started)
+            metrics.observe("santa_update_db_queries", labels, usage[0])
+            metrics.observe("santa_update_db_seconds", labels, usage[1])
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: время конкретного хендлера"""
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe(
+                "santa_handler_seconds", (('handler', data['handler'].callback.__name__),),
+                time.perf_counter() - started
+            )
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: задержка каждого метода Bot API и ошибки"""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        labels = (('method', method.__api_method__),)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            metrics.inc("santa_api_errors_total", (*labels, ('error', 'retry_after')))
+            raise
+        except Exception as e:
+            metrics.inc("santa_api_errors_total", (*labels, ('error', type(e).__name__)))
+            raise
+        finally:
+            metrics.observe("santa_api_seconds", labels, time.perf_counter() - started)
+
+@metrics.collector
+def collect_component_stats():
+    """Счётчики, которые компоненты и так ведут у себя (кэши, буферы, рассылка)"""
+    yield "santa_db_transactions_total", "counter", "Транзакции SQLite", (), storage.transactions
+    if storage.count_statements:
+        yield "santa_db_statements_total", "counter", "SQL-операторы SQLite", (), storage.statements
+    for cache, stats in (('settings', settings_cache.stats()), ('fsm', fsm_storage.stats()),
+                         ('leaderboard', leaderboard_cache.stats())):
+        yield "santa_cache_hits_total", "counter", "Попадания в кэши", (('cache', cache),), stats['hits']
+        yield "santa_cache_misses_total", "counter", "Промахи кэшей", (('cache', cache),), stats['misses']
+    for scope, count in throttling.stats['dropped'].items():
+        yield "santa_throttled_total", "counter", "Отброшено ограничением частоты", (('scope', scope),), count
+    for key, value in broadcaster.stats.items():
+        yield "santa_broadcast_total", "counter", "Личные сообщения рассылки", (('result', key),), value
+    yield "santa_score_flushes_total", "counter", "Сбросы буфера очков", (), score_buffer.stats['flushes']
+    yield "santa_join_edits_total", "counter", "Правки призыва к участию", (), join_updater.stats['edits']
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+async def start_metrics_server(port: int) -> Optional[web.AppRunner]:
+    """Локальный HTTP-сервер с /metrics; отдельный от webhook, чтобы не светить метрики наружу"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+# === БАЗА ДАННЫХ ===
+DB_NAME = os.getenv("DB_NAME", "santa.db")
+
+class Storage:
+    """
+    Асинхронный доступ к SQLite через одно долгоживущее соединение.
+    Все запросы выполняются в отдельном потоке, поэтому дисковый I/O
+    не блокирует event loop. Поток один — запросы сериализуются,
+    и соединение никогда не используется конкурентно.
+    """
+
+    def __init__(self, path: str, count_statements: bool = False):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Счётчики для оценки нагрузки: транзакции и отдельные SQL-операторы.
+        # Операторы считает trace callback — это вызов Python на каждый запрос, поэтому он включается явно
+        self.count_statements = count_statements
+        self.transactions = 0
+        self.statements = 0
+
+    def open(self):
+        if self._conn is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="santa-db")
+        self._conn = self._executor.submit(self._connect).result()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        if self.count_statements:
+            conn.set_trace_callback(self._count_statement)
+        return conn
+
+    def _count_statement(self, sql: str):
+        self.statements += 1
+
+    async def close(self):
+        if self._conn is None:
+            return
+        conn, executor = self._conn, self._executor
+        self._conn = None
+        self._executor = None
+        await asyncio.get_running_loop().run_in_executor(executor, conn.close)
+        executor.shutdown(wait=True)
+
+    async def run(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке БД внутри транзакции"""
+        if self._conn is None:
+            raise RuntimeError("Хранилище не открыто")
+        self.transactions += 1
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._transaction, fn, args)
+        usage = db_usage.get()
+        if usage is None:
+            return await future
+        started = time.perf_counter()
+        try:
+            return await future
+        finally:
+            usage[0] += 1
+            usage[1] += time.perf_counter() - started
+
+    def _transaction(self, fn, args):
+        conn = self._conn
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except Exception as e:
+            logger.error(f"DB Error: {e}")
+            conn.rollback()
+            raise
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params) -> int:
+        return await self.run(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+storage = Storage(DB_NAME, count_statements=os.getenv("DB_COUNT_STATEMENTS", "0") == "1")
+
+# === МИГРАЦИИ ===
+def _migrate_base_schema(db: sqlite3.Connection):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS games (
+            chat_id TEXT PRIMARY KEY,
+            lang TEXT DEFAULT 'ru',
+            theme TEXT DEFAULT 'christmas',
+            draw_time INTEGER,
+            end_time INTEGER
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS players (
+            user_id TEXT,
+            chat_id TEXT,
+            full_name TEXT,
+            nick TEXT,
+            gift TEXT,
+            score INTEGER DEFAULT 0,
+            target_id TEXT,
+            premium_nick TEXT,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS achievements (
+            player_id TEXT,
+            name TEXT,
+            PRIMARY KEY (player_id, name)
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            chat_id TEXT,
+            recipient TEXT,
+            text TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            error TEXT
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status)')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            job_id TEXT PRIMARY KEY,
+            kind TEXT,
+            chat_id TEXT,
+            run_at INTEGER,
+            status TEXT DEFAULT 'pending'
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs (status, run_at)')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS draw_exclusions (
+            chat_id TEXT,
+            giver_id TEXT,
+            receiver_id TEXT,
+            PRIMARY KEY (chat_id, giver_id, receiver_id)
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS draw_groups (
+            chat_id TEXT,
+            user_id TEXT,
+            group_name TEXT,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+
+def _migrate_hot_indexes(db: sqlite3.Connection):
+    # Таблица лидеров: фильтр по чату + сортировка по очкам, nick — чтобы не ходить в таблицу
+    db.execute('CREATE INDEX IF NOT EXISTS idx_players_chat_score ON players (chat_id, score DESC, nick)')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_players_chat_nick ON players (chat_id, nick)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_players_chat_premium ON players (chat_id, premium_nick)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox (chat_id, kind, status)')
+
+def _migrate_chat_achievements(db: sqlite3.Connection):
+    db.execute('ALTER TABLE achievements RENAME TO achievements_legacy')
+    db.execute('''
+        CREATE TABLE achievements (
+            chat_id TEXT,
+            player_id TEXT,
+            name TEXT,
+            PRIMARY KEY (chat_id, player_id, name)
+        )
+    ''')
+    # Старые ачивки не знали чата — переносим их во все игры этого участника
+    db.execute('''
+        INSERT OR IGNORE INTO achievements (chat_id, player_id, name)
+        SELECT p.chat_id, a.player_id, a.name
+        FROM achievements_legacy a JOIN players p ON p.user_id = a.player_id
+    ''')
+    db.execute('DROP TABLE achievements_legacy')
+
+def _migrate_fsm_states(db: sqlite3.Connection):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_at)')
+
+def _migrate_job_attempts(db: sqlite3.Connection):
+    db.execute('ALTER TABLE scheduled_jobs ADD COLUMN attempts INTEGER DEFAULT 0')
+    db.execute('ALTER TABLE scheduled_jobs ADD COLUMN error TEXT')
+
+def _migrate_cover_leaderboard(db: sqlite3.Connection):
+    # Кэши таблицы лидеров и ростера ников грузят (user_id, nick, score) по чату — user_id тоже в индекс
+    db.execute('DROP INDEX IF EXISTS idx_players_chat_score')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_players_chat_score ON players (chat_id, score DESC, nick, user_id)')
+
+# Упорядоченный список миграций: (версия, описание, функция). Только дописывать в конец!
+MIGRATIONS = [
+    (1, "базовая схема", _migrate_base_schema),
+    (2, "индексы горячих запросов", _migrate_hot_indexes),
+    (3, "ачивки в разрезе чата", _migrate_chat_achievements),
+    (4, "FSM-состояния в базе", _migrate_fsm_states),
+    (5, "попытки задач планировщика", _migrate_job_attempts),
+    (6, "покрывающий индекс таблицы лидеров", _migrate_cover_leaderboard),
+]
+
+def _apply_migrations(db: sqlite3.Connection) -> int:
+    db.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at INTEGER)')
+    db.commit()
+    current = db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        # Каждая миграция — отдельная транзакция вместе с записью о версии
+        db.execute('BEGIN')
+        try:
+            migrate(db)
+            db.execute('INSERT INTO schema_version (version, applied_at) VALUES (?, ?)', (version, int(time.time())))
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.error(f"Ошибка миграции {version} ({description})")
+            raise
+        logger.info(f"Применена миграция {version}: {description}")
+        current = version
+    return current
+
+async def init_db(migrate: bool = True):
+    storage.open()
+    # В шардированном режиме миграции выполняет только фронт-процесс
+    if migrate:
+        version = await storage.run(_apply_migrations)
+        logger.info(f"Версия схемы базы: {version}")
+
+# === КЭШ НАСТРОЕК ЧАТОВ ===
+DEFAULT_SETTINGS = {'lang': 'ru', 'theme': 'christmas', 'draw_time': None, 'end_time': None}
+
+class ChatSettingsCache:
+    """
+    Ограниченный LRU-кэш настроек чатов (lang/theme/draw_time/end_time) с TTL.
+    Отсутствие игры тоже кэшируется (exists=False), чтобы чаты без игры
+    не ходили в базу на каждое сообщение.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._data.get(chat_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[chat_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(chat_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, chat_id: str, settings: Dict[str, Any]):
+        self._data[chat_id] = (time.monotonic() + self.ttl, settings)
+        self._data.move_to_end(chat_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, chat_id: str, **fields):
+        """Обновляет закэшированную запись после записи в базу (write-through)"""
+        entry = self._data.get(chat_id)
+        if entry is None:
+            return
+        self.put(chat_id, {**entry[1], **fields})
+
+    def invalidate(self, chat_id: str):
+        self._data.pop(chat_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+
+settings_cache = ChatSettingsCache(
+    maxsize=int(os.getenv("SETTINGS_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("SETTINGS_CACHE_TTL", "300")),
+)
+
+async def get_chat_settings(chat_id) -> Dict[str, Any]:
+    """Возвращает настройки чата из кэша, при промахе — из таблицы games"""
+    chat_id = str(chat_id)
+    settings = settings_cache.get(chat_id)
+    if settings is not None:
+        return settings
+    
+    row = await storage.fetchone(
+        'SELECT lang, theme, draw_time, end_time FROM games WHERE chat_id = ?', (chat_id,)
+    )
+    if row:
+        settings = {
+            'lang': row['lang'] or DEFAULT_SETTINGS['lang'],
+            'theme': row['theme'] or DEFAULT_SETTINGS['theme'],
+            'draw_time': row['draw_time'],
+            'end_time': row['end_time'],
+            'exists': True,
+        }
+    else:
+        settings = {**DEFAULT_SETTINGS, 'exists': False}
+    settings_cache.put(chat_id, settings)
+    return settings
+
+# === ИНДЕКС УЧАСТНИКОВ ===
+class MembershipIndex:
+    """
+    Полная in-memory копия того, в каких чатах есть игра и кто в них
+    зарегистрирован. Прогревается при старте из games/players и обновляется
+    при каждой записи, поэтому отвечает на вопросы "есть ли игра" и
+    "зарегистрирован ли" за O(1) без обращения к базе.
+    """
+
+    def __init__(self):
+        self.games: set = set()
+        self.members: Dict[str, set] = {}
+
+    def has_game(self, chat_id: str) -> bool:
+        return chat_id in self.games
+
+    def is_member(self, chat_id: str, user_id: str) -> bool:
+        members = self.members.get(chat_id)
+        return members is not None and user_id in members
+
+    def add_game(self, chat_id: str):
+        self.games.add(chat_id)
+
+    def add_member(self, chat_id: str, user_id: str):
+        self.members.setdefault(chat_id, set()).add(user_id)
+
+    def load(self, games, players):
+        # Каждый шард держит в памяти только свои чаты
+        self.games = {chat_id for chat_id in games if owns_chat(chat_id)}
+        members: Dict[str, set] = {}
+        for user_id, chat_id in players:
+            if chat_id in self.games or owns_chat(chat_id):
+                members.setdefault(chat_id, set()).add(user_id)
+        self.members = members
+
+membership = MembershipIndex()
+
+def _load_membership(db: sqlite3.Connection):
+    games = [row[0] for row in db.execute('SELECT chat_id FROM games')]
+    players = db.execute('SELECT user_id, chat_id FROM players').fetchall()
+    return games, players
+
+async def warm_membership_index():
+    games, players = await storage.run(_load_membership)
+    membership.load(games, players)
+    logger.info(f"Индекс участников прогрет: {len(membership.games)} игр, {len(players)} участников")
+
+# === РОСТЕР НИКОВ ===
+class NickRoster:
+    """
+    Кэш списка ников чата для /santabingo. Список перемешивается один раз
+    при загрузке и живёт ttl секунд, новые участники дописываются в конец,
+    так что команда и листание страниц не ходят в базу и не зависят от
+    размера чата.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def get(self, chat_id: str) -> tuple:
+        """Возвращает (entries, positions): список (user_id, nick) и индекс user_id -> позиция"""
+        entry = self._data.get(chat_id)
+        if entry is not None and entry[0] >= time.monotonic():
+            self._data.move_to_end(chat_id)
+            return entry[1], entry[2]
+        rows = await storage.fetchall('SELECT user_id, nick FROM players WHERE chat_id = ?', (chat_id,))
+        entries = [(row['user_id'], row['nick']) for row in rows]
+        random.shuffle(entries)
+        positions = {user_id: i for i, (user_id, _) in enumerate(entries)}
+        self._data[chat_id] = (time.monotonic() + self.ttl, entries, positions)
+        self._data.move_to_end(chat_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return entries, positions
+
+    def add(self, chat_id: str, user_id: str, nick: str):
+        entry = self._data.get(chat_id)
+        if entry is None or user_id in entry[2]:
+            return
+        entry[2][user_id] = len(entry[1])
+        entry[1].append((user_id, nick))
+
+    def invalidate(self, chat_id: str):
+        self._data.pop(chat_id, None)
+
+nick_roster = NickRoster(
+    maxsize=int(os.getenv("ROSTER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("ROSTER_CACHE_TTL", "60")),
+)
+BINGO_PAGE_SIZE = int(os.getenv("BINGO_PAGE_SIZE", "8"))
+
+def bingo_keyboard(entries: list, target_id: str, page: int) -> InlineKeyboardMarkup:
+    """Одна страница вариантов; страницы листаются по кругу"""
+    pages = max((len(entries) + BINGO_PAGE_SIZE - 1) // BINGO_PAGE_SIZE, 1)
+    page %= pages
+    kb = [
+        [InlineKeyboardButton(text=nick, callback_data=pack_callback(CB_GUESS, int(target_id), int(user_id)))]
+        for user_id, nick in entries[page * BINGO_PAGE_SIZE:(page + 1) * BINGO_PAGE_SIZE]
+    ]
+    if pages > 1:
+        kb.append([
+            InlineKeyboardButton(text="◀️", callback_data=pack_callback(CB_BINGO, int(target_id), page - 1)),
+            InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=pack_callback(CB_BINGO, int(target_id), page)),
+            InlineKeyboardButton(text="▶️", callback_data=pack_callback(CB_BINGO, int(target_id), page + 1)),
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
 
 # === FSM ===
 class GiftState(StatesGroup):
@@ -213,88 +1028,1228 @@ class SetupState(StatesGroup):
 class PremiumState(StatesGroup):
     choosing = State()
 
-# === ГЛОБАЛЬНЫЕ ===
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+class SQLiteFSMStorage(BaseStorage):
+    """
+    FSM-хранилище в той же SQLite-базе: недозаполненные /setup и /mygift
+    переживают рестарт и видны всем процессам. Состояния, которые не
+    трогали дольше ttl секунд, считаются брошенными и удаляются.
+    Перед базой стоит LRU-кэш горячих ключей (write-through); у записи
+    кэша свой короткий cache_ttl, чтобы чужие процессы не читали
+    устаревшее состояние дольше него. cache_ttl=0 отключает кэш.
+    """
+
+    def __init__(self, db: "Storage", ttl: float = 86400, cache_size: int = 10000, cache_ttl: float = 30):
+        self.db = db
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    def _cached(self, key: str) -> Optional[tuple]:
+        entry = self._cache.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._cache[key]
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def _remember(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        if self.cache_ttl <= 0:
+            return
+        self._cache[key] = (time.monotonic() + self.cache_ttl, state, data)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _read_row(self, conn: sqlite3.Connection, key: str, now: int):
+        row = conn.execute(
+            'SELECT state, data FROM fsm_states WHERE key = ? AND updated_at >= ?', (key, now - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None, {}
+        return row['state'], json.loads(row['data']) if row['data'] else {}
+
+    def _write_row(self, conn: sqlite3.Connection, key: str, field: str, value, now: int):
+        state, data = self._read_row(conn, key, now)
+        if field == 'state':
+            state = value
+        else:
+            data = value
+        # Пустую запись (после state.clear()) не храним
+        if state is None and not data:
+            conn.execute('DELETE FROM fsm_states WHERE key = ?', (key,))
+        else:
+            conn.execute('''
+                INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            ''', (key, state, json.dumps(data, ensure_ascii=False) if data else None, now))
+        return state, data
+
+    async def _load(self, key: StorageKey) -> tuple:
+        skey = self._key(key)
+        cached = self._cached(skey)
+        if cached is not None:
+            return cached
+        state, data = await self.db.run(self._read_row, skey, int(time.time()))
+        self._remember(skey, state, data)
+        return state, data
+
+    async def _store(self, key: StorageKey, field: str, value):
+        skey = self._key(key)
+        state, data = await self.db.run(self._write_row, skey, field, value, int(time.time()))
+        self._remember(skey, state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._store(key, 'state', state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._store(key, 'data', data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(key))[1].copy()
+
+    async def purge_expired(self) -> int:
+        removed = await self.db.execute(
+            'DELETE FROM fsm_states WHERE updated_at < ?', (int(time.time() - self.ttl),)
+        )
+        if removed:
+            logger.info(f"Удалено брошенных FSM-состояний: {removed}")
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+fsm_storage = SQLiteFSMStorage(
+    storage,
+    ttl=float(os.getenv("FSM_STATE_TTL", "86400")),
+    cache_size=int(os.getenv("FSM_CACHE_SIZE", "10000")),
+    cache_ttl=float(os.getenv("FSM_CACHE_TTL", "30")),
+)
+
+def schedule_fsm_cleanup():
+    scheduler.add_job(
+        fsm_storage.purge_expired, 'interval', seconds=3600,
+        id='fsm_purge', replace_existing=True, coalesce=True
+    )
+
+# === ГЛОБАЛЬНЫЕ ===
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+dp = Dispatcher(storage=fsm_storage)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.callback_query.outer_middleware(CallbackDataMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+_handler_metrics = HandlerMetricsMiddleware()
+_log_context = LogContextMiddleware()
+for _observer in (dp.message, dp.callback_query, dp.pre_checkout_query, dp.chat_member, dp.my_chat_member):
+    _observer.middleware(_handler_metrics)
+    _observer.middleware(_log_context)
+scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+
+# === РАССЫЛКА ===
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """Неблокирующий вариант acquire: False, если токенов сейчас нет"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class Broadcaster:
+    """
+    Очередь исходящих сообщений с пулом воркеров.
+    Глобальный лимит задаёт TokenBucket, отдельный интервал ограничивает
+    частоту сообщений в один чат. Каждое сообщение хранится в таблице outbox
+    со статусом pending/sending/sent/failed, поэтому после падения недоставленные
+    сообщения досылаются при следующем запуске. Перед отправкой воркер
+    захватывает строку: удалённые или уже отправленные строки, оставшиеся
+    в очереди в памяти, пропускаются.
+    """
+
+    def __init__(self, bot: Bot, workers: int = 8, rate: float = 30.0,
+                 per_chat_interval: float = 1.0, max_attempts: int = 5):
+        self.bot = bot
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self._queue: Optional[asyncio.Queue] = None
+        self.stats = {'sent': 0, 'failed': 0, 'retry_after': 0, 'skipped': 0}
+        self._chat_next: Dict[str, float] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # Очередь создаётся лениво, уже внутри работающего event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def start(self):
+        """Запускает воркеров и возвращает в очередь всё, что не было доставлено"""
+        pending = await storage.fetchall(
+            "SELECT id, chat_id, recipient, text, status FROM outbox WHERE status IN ('pending', 'sending') ORDER BY id"
+        )
+        pending = [row for row in pending if owns_chat(row['chat_id'])]
+        # 'sending' — отправка прервана падением процесса, строку нужно захватить заново
+        await storage.executemany(
+            "UPDATE outbox SET status = 'pending' WHERE id = ? AND status = 'sending'",
+            [(row['id'],) for row in pending if row['status'] == 'sending']
+        )
+        self.submit(pending)
+        if pending:
+            logger.info("Возобновлена рассылка: %s недоставленных сообщений", len(pending))
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, rows):
+        """Ставит в очередь строки outbox (id, recipient, text)"""
+        for row in rows:
+            self.queue.put_nowait((row['id'], row['recipient'], row['text']))
+
+    async def _wait_chat(self, chat_id: str):
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        if len(self._chat_next) > 10000:
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _mark(self, item_id: int, status: str, attempts: int, error: Optional[str] = None):
+        await storage.execute(
+            'UPDATE outbox SET status = ?, attempts = ?, error = ? WHERE id = ?',
+            (status, attempts, error, item_id)
+        )
+
+    async def _deliver(self, item_id: int, recipient: str, text: str):
+        # Строку могли удалить (новая жеребьёвка) или уже отправить, пока она ждала в очереди
+        claimed = await storage.execute(
+            "UPDATE outbox SET status = 'sending' WHERE id = ? AND status = 'pending'", (item_id,)
+        )
+        if not claimed:
+            self.stats['skipped'] += 1
+            return
+        attempts = 0
+        while True:
+            await self._wait_chat(recipient)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(recipient, text)
+            except TelegramRetryAfter as e:
+                self.stats['retry_after'] += 1
+                logger.warning("Flood control при рассылке, пауза %s с", e.retry_after)
+                self.bucket.pause(e.retry_after)
+                continue
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Пользователь не начинал диалог с ботом или заблокировал его — повтор не поможет
+                self.stats['failed'] += 1
+                await self._mark(item_id, 'failed', attempts + 1, str(e))
+                return
+            except Exception as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    self.stats['failed'] += 1
+                    logger.error("Ошибка отправки сообщения пользователю %s: %s", recipient, e)
+                    await self._mark(item_id, 'failed', attempts, str(e))
+                    return
+                await asyncio.sleep(min(2 ** attempts, 30))
+                continue
+            self.stats['sent'] += 1
+            await self._mark(item_id, 'sent', attempts + 1)
+            return
+
+    async def _worker(self):
+        while True:
+            item_id, recipient, text = await self.queue.get()
+            try:
+                await self._deliver(item_id, recipient, text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка воркера рассылки: %s", e)
+            finally:
+                self.queue.task_done()
+
+broadcaster = Broadcaster(
+    bot,
+    workers=int(os.getenv("BROADCAST_WORKERS", "8")),
+    rate=float(os.getenv("BROADCAST_RATE", "30")),
+    per_chat_interval=float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1.0")),
+)
+
+# === ОГРАНИЧЕНИЕ ЧАСТОТЫ ===
+# Лимиты по командам и видам кнопок:
+# (токенов в секунду на пользователя, запас, токенов в секунду на чат, запас).
+# Ведро на чат есть только у дорогих команд: кнопки жмут сразу сотни разных
+# людей, и общий лимит чата отсекал бы честных игроков — от спама одного
+# пользователя защищает его собственное ведро
+THROTTLE_LIMITS = {
+    'default': (1.0, 5, None, None),
+    'santabingo': (0.2, 3, 1.0, 10),
+    'leaderboard': (0.1, 2, 0.5, 5),
+    'guess': (1.0, 3, None, None),
+    'bingo': (2.0, 5, None, None),
+    'join': (0.5, 3, None, None),
+}
+# Переопределение через окружение: "santabingo:0.5:5:2:20,guess:2:5" (без двух последних — без лимита на чат)
+for _spec in filter(None, os.getenv("THROTTLE_LIMITS", "").split(",")):
+    _scope, *_values = _spec.strip().split(":")
+    _chat = (float(_values[2]), int(_values[3])) if len(_values) > 2 else (None, None)
+    THROTTLE_LIMITS[_scope] = (float(_values[0]), int(_values[1]), *_chat)
+
+CALLBACK_SCOPES = {CB_JOIN: 'join', CB_HELP: 'help', CB_THEME: 'theme', CB_GUESS: 'guess', CB_BINGO: 'bingo', CB_BUY: 'buy'}
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Отсекает лишние команды и нажатия кнопок до хендлеров, то есть до базы
+    и Telegram API. У каждого пользователя и чата свой token bucket на
+    команду; вёдра лежат в LRU, а ведро, не тронутое дольше idle_ttl,
+    уже полное и выбрасывается без потери состояния.
+    """
+
+    def __init__(self, limits: Dict[str, tuple], maxsize: int = 100000, idle_ttl: float = 600):
+        self.limits = limits
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self._buckets: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._commands: Optional[set] = None
+        self.passed = 0
+        self.dropped: Dict[str, int] = {}
+
+    def _known_commands(self) -> set:
+        # Хендлеры регистрируются после middleware, поэтому список собираем при первом апдейте
+        if self._commands is None:
+            commands = set()
+            for handler in dp.message.handlers:
+                for flt in handler.filters or ():
+                    if isinstance(flt.callback, Command):
+                        commands.update(c.lower() for c in flt.callback.commands if isinstance(c, str))
+            self._commands = commands
+        return self._commands
+
+    def _scope(self, event, data) -> Optional[str]:
+        if isinstance(event, Message):
+            text = event.text or ""
+            if not text.startswith("/"):
+                return None  # обычные сообщения обрабатываются в памяти
+            command = text[1:].split(maxsplit=1)[0].split("@")[0].lower() if len(text) > 1 else ""
+            # Выдуманные команды делят одно ведро: иначе каждая новая получала бы полный запас,
+            # а ключи вёдер и счётчиков росли бы по желанию пользователей
+            if command in self.limits or command in self._known_commands():
+                return command
+            return 'default'
+        cb = data.get('cb')
+        return CALLBACK_SCOPES.get(cb[0]) if cb else None
+
+    def _bucket(self, key: tuple, rate: float, capacity: int) -> TokenBucket:
+        now = time.monotonic()
+        entry = self._buckets.get(key)
+        if entry is None:
+            entry = (TokenBucket(rate, capacity), now)
+        else:
+            entry = (entry[0], now)
+        self._buckets[key] = entry
+        self._buckets.move_to_end(key)
+        while self._buckets:
+            oldest_key, (_, seen) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.maxsize and now - seen < self.idle_ttl:
+                break
+            del self._buckets[oldest_key]
+        return entry[0]
+
+    def allow(self, scope: str, user_id: Optional[int], chat_id: Optional[int]) -> bool:
+        user_rate, user_burst, chat_rate, chat_burst = self.limits.get(scope) or self.limits['default']
+        if user_id is not None and not self._bucket((scope, 'u', user_id), user_rate, user_burst).try_acquire():
+            return False
+        if chat_rate is None or chat_id is None or chat_id == user_id:
+            return True
+        if not self._bucket((scope, 'c', chat_id), chat_rate, chat_burst).try_acquire():
+            return False
+        return True
+
+    async def __call__(self, handler, event, data):
+        scope = self._scope(event, data)
+        if scope is None:
+            return await handler(event, data)
+        user = event.from_user
+        chat = event.chat if isinstance(event, Message) else (event.message.chat if event.message else None)
+        if self.allow(scope, user.id if user else None, chat.id if chat else None):
+            self.passed += 1
+            return await handler(event, data)
+        
+        self.dropped[scope] = self.dropped.get(scope, 0) + 1
+        if not isinstance(event, Message):
+            # Кнопку нужно "отпустить", язык берём только из кэша — без базы
+            settings = settings_cache.get(str(chat.id)) if chat else None
+            lang = settings['lang'] if settings else DEFAULT_SETTINGS['lang']
+            try:
+                await event.answer(get_text('throttled', lang))
+            except Exception as e:
+                logger.debug("Не удалось ответить на отброшенный callback: %s", e)
+        return None
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {'passed': self.passed, 'dropped': dict(self.dropped), 'buckets': len(self._buckets)}
+
+throttling = ThrottlingMiddleware(
+    THROTTLE_LIMITS,
+    maxsize=int(os.getenv("THROTTLE_MAX_BUCKETS", "100000")),
+    idle_ttl=float(os.getenv("THROTTLE_IDLE_TTL", "600")),
+)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+
+# === БУФЕР ОЧКОВ ===
+class ScoreBuffer:
+    """
+    Копит приращения очков в памяти по (chat_id, user_id) и сбрасывает их
+    в базу одной транзакцией раз в interval секунд или после max_events
+    событий. Перед чтением очков (лидерборд, финал) буфер сбрасывается
+    синхронно, поэтому читатели всегда видят актуальные значения.
+    """
+
+    def __init__(self, interval: float = 0.5, max_events: int = 500):
+        self.interval = interval
+        self.max_events = max_events
+        self._pending: Dict[tuple, int] = {}
+        self._events = 0
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self.stats = {
+            'flushes': 0,
+            'flushed_rows': 0,
+            'flushed_events': 0,
+            'last_flush_rows': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+        }
+
+    def add(self, chat_id: str, user_id: str, delta: int = 1):
+        key = (chat_id, user_id)
+        self._pending[key] = self._pending.get(key, 0) + delta
+        self._events += 1
+        if self._events >= self.max_events:
+            task = asyncio.create_task(self._safe_flush())
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    def pending_for(self, chat_id: str) -> Dict[str, int]:
+        """Ещё не записанные в базу приращения очков чата"""
+        return {user_id: delta for (chat, user_id), delta in self._pending.items() if chat == chat_id}
+
+    async def flush(self):
+        if not self._pending:
+            return
+        # Забираем накопленное целиком: новые события пойдут уже в следующий пакет
+        batch, events = self._pending, self._events
+        self._pending, self._events = {}, 0
+        started = time.perf_counter()
+        try:
+            await storage.executemany(
+                'UPDATE players SET score = score + ? WHERE user_id = ? AND chat_id = ?',
+                [(delta, user_id, chat_id) for (chat_id, user_id), delta in batch.items()]
+            )
+        except Exception:
+            # Возвращаем пакет в буфер, чтобы не потерять очки
+            for key, delta in batch.items():
+                self._pending[key] = self._pending.get(key, 0) + delta
+            self._events += events
+            raise
+        elapsed = (time.perf_counter() - started) * 1000
+        self.stats['flushes'] += 1
+        self.stats['flushed_rows'] += len(batch)
+        self.stats['flushed_events'] += events
+        self.stats['last_flush_rows'] = len(batch)
+        self.stats['last_flush_ms'] = round(elapsed, 3)
+        self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], round(elapsed, 3))
+
+    async def _safe_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("Ошибка сброса буфера очков: %s", e)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._safe_flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+        await self.flush()
+
+score_buffer = ScoreBuffer(
+    interval=int(os.getenv("SCORE_FLUSH_INTERVAL_MS", "500")) / 1000,
+    max_events=int(os.getenv("SCORE_FLUSH_MAX_EVENTS", "500")),
+)
+
+# === ТАБЛИЦА ЛИДЕРОВ ===
+class LeaderboardCache:
+    """
+    Топ-size игроков по чатам в памяти. При первом обращении чат грузится
+    из базы целиком (очки и ники всех игроков), дальше каждое угаданное
+    очко поправляет топ за O(size) без запросов. Очки только растут, поэтому
+    в топ может попасть лишь тот, чьи очки только что изменились. Готовый
+    текст таблицы кэшируется и сбрасывается, только когда меняется топ.
+    """
+
+    def __init__(self, size: int = 10, maxsize: int = 1000, ttl: float = 300):
+        self.size = size
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, dict]" = OrderedDict()
+        self._loading: Dict[str, list] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, chat_id: str) -> dict:
+        board = self._data.get(chat_id)
+        if board is not None and board['expires'] >= time.monotonic():
+            self._data.move_to_end(chat_id)
+            self.hits += 1
+            return board
+        self.misses += 1
+        task = self._tasks.get(chat_id)
+        if task is None:
+            task = self._tasks[chat_id] = asyncio.create_task(self._warm(chat_id))
+            task.add_done_callback(lambda _: self._tasks.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def _warm(self, chat_id: str) -> dict:
+        # Между снимком буфера и отправкой SELECT в поток базы нет await: всё,
+        # что уже ушло в базу, попадёт в выборку, остальное — в base или recorded
+        self._loading[chat_id] = recorded = []
+        base = score_buffer.pending_for(chat_id)
+        try:
+            rows = await storage.fetchall('SELECT user_id, nick, score FROM players WHERE chat_id = ?', (chat_id,))
+        finally:
+            self._loading.pop(chat_id, None)
+        
+        scores = {row['user_id']: (row['score'] or 0) + base.get(row['user_id'], 0) for row in rows}
+        board = {
+            'scores': scores,
+            'nicks': {row['user_id']: row['nick'] for row in rows},
+            'top': heapq.nlargest(self.size, scores, key=scores.get),
+            'text': None,
+            'lang': None,
+            'expires': time.monotonic() + self.ttl,
+        }
+        for user_id, delta in recorded:
+            self._apply(board, user_id, delta)
+        self._data[chat_id] = board
+        self._data.move_to_end(chat_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return board
+
+    def _apply(self, board: dict, user_id: str, delta: int):
+        scores, top = board['scores'], board['top']
+        if user_id not in board['nicks']:
+            return  # угадывал не участник игры — в базе очки тоже не изменятся
+        scores[user_id] = score = scores.get(user_id, 0) + delta
+        if user_id in top:
+            i = top.index(user_id)
+        elif len(top) < self.size or score > scores[top[-1]]:
+            top.append(user_id)
+            i = len(top) - 1
+        else:
+            return
+        while i > 0 and scores[top[i - 1]] < score:
+            top[i - 1], top[i] = top[i], top[i - 1]
+            i -= 1
+        del top[self.size:]
+        board['text'] = None
+
+    def record(self, chat_id: str, user_id: str, delta: int = 1):
+        """Учитывает изменение очков (вызывается рядом с score_buffer.add)"""
+        loading = self._loading.get(chat_id)
+        if loading is not None:
+            loading.append((user_id, delta))
+            return
+        board = self._data.get(chat_id)
+        if board is not None:
+            self._apply(board, user_id, delta)
+
+    def add_player(self, chat_id: str, user_id: str, nick: str):
+        board = self._data.get(chat_id)
+        if board is None or user_id in board['nicks']:
+            return
+        board['nicks'][user_id] = nick
+        board['scores'][user_id] = 0
+        if len(board['top']) < self.size:
+            board['top'].append(user_id)
+            board['text'] = None
+
+    def rename(self, chat_id: str, user_id: str, nick: str):
+        board = self._data.get(chat_id)
+        if board is None or user_id not in board['nicks']:
+            return
+        board['nicks'][user_id] = nick
+        if user_id in board['top']:
+            board['text'] = None
+
+    async def render(self, chat_id: str, lang: str) -> Optional[str]:
+        """Текст таблицы лидеров или None, если игроков нет"""
+        board = await self.get(chat_id)
+        if not board['top']:
+            return None
+        if board['text'] is None or board['lang'] != lang:
+            scores, nicks = board['scores'], board['nicks']
+            player_list = "".join(
+                f"{i}. {nicks[user_id]} — {scores[user_id]} очков\n" for i, user_id in enumerate(board['top'], 1)
+            )
+            board['text'] = get_text('leaderboard', lang, list=player_list)
+            board['lang'] = lang
+        return board['text']
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'chats': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+
+leaderboard_cache = LeaderboardCache(
+    size=10,
+    maxsize=int(os.getenv("LEADERBOARD_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("LEADERBOARD_CACHE_TTL", "300")),
+)
+
+# === СЧЁТЧИК В ПРИЗЫВЕ К УЧАСТИЮ ===
+def join_keyboard() -> InlineKeyboardMarkup:
+    return texts.keyboard(('join',), lambda: InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎄 Участвовать в игре", callback_data=pack_callback(CB_JOIN))]
+    ]))
+
+class JoinMessageUpdater:
+    """
+    Склеивает правки сообщения с кнопкой "Участвовать в игре": первое нажатие
+    правит сообщение сразу, все последующие в течение interval секунд дают
+    одну правку в конце окна с последним числом участников. Число берётся
+    из индекса участников, без запросов к базе.
+    """
+
+    def __init__(self, interval: float = 3.0):
+        self.interval = interval
+        self._dirty: set = set()
+        self._tasks: Dict[tuple, asyncio.Task] = {}
+        self.requested = 0
+        self.edits = 0
+
+    def request(self, chat_id: str, message_id: int, lang: str):
+        key = (chat_id, message_id)
+        self.requested += 1
+        self._dirty.add(key)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key, lang))
+
+    async def _run(self, key: tuple, lang: str):
+        chat_id, message_id = key
+        last_count = None
+        try:
+            while key in self._dirty:
+                self._dirty.discard(key)
+                count = len(membership.members.get(chat_id, ()))
+                if count != last_count:
+                    try:
+                        await bot.edit_message_text(
+                            get_text('auto_register_call', lang, count=count),
+                            chat_id=chat_id, message_id=message_id, reply_markup=join_keyboard()
+                        )
+                        self.edits += 1
+                        last_count = count
+                    except TelegramRetryAfter as e:
+                        self._dirty.add(key)
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    except TelegramBadRequest as e:
+                        last_count = count  # "message is not modified" и удалённые сообщения
+                        logger.debug("Правка призыва в чате %s не нужна: %s", chat_id, e)
+                await asyncio.sleep(self.interval)
+        except Exception as e:
+            logger.error("Ошибка обновления призыва в чате %s: %s", chat_id, e)
+        finally:
+            self._tasks.pop(key, None)
+
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'requested': self.requested, 'edits': self.edits}
+
+join_updater = JoinMessageUpdater(interval=float(os.getenv("JOIN_EDIT_INTERVAL", "3.0")))
+
+# === ЖЕРЕБЬЁВКА ===
+class DrawInfeasible(Exception):
+    """Жеребьёвка невозможна при заданных ограничениях"""
+
+# Сколько случайных кругов пробуем до перехода к поиску паросочетания
+DRAW_CYCLE_ATTEMPTS = 10
+# Сколько случайных свободных получателей пробует жадный шаг для одного дарителя
+DRAW_GREEDY_PROBES = 32
+
+def solve_draw(user_ids: List[str], exclusions: Optional[Dict[str, set]] = None,
+               groups: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Подбирает получателя каждому участнику (giver -> receiver) так, чтобы
+    никто не дарил себе, получателям из exclusions[giver] и участникам своей
+    команды из groups. Сначала пробует несколько случайных кругов, затем
+    ищет совершенное паросочетание (жадно + фазы увеличивающих путей).
+    Бросает DrawInfeasible, если подходящего распределения не существует.
+    """
+    n = len(user_ids)
+    if n < 2:
+        raise DrawInfeasible("Недостаточно участников для жеребьевки (минимум 2)")
+    exclusions = exclusions or {}
+    groups = groups or {}
+    
+    index = {u: i for i, u in enumerate(user_ids)}
+    # Множества запретов используются как есть, по user_id: при плотных запретах
+    # перевод их в индексы стоил бы больше, чем весь поиск
+    empty = frozenset()
+    banned = [exclusions.get(u, empty) for u in user_ids]
+    group_of = [groups.get(u) for u in user_ids]
+    
+    def allowed(g: int, r: int) -> bool:
+        return g != r and user_ids[r] not in banned[g] and (group_of[g] is None or group_of[g] != group_of[r])
+    
+    # Быстрые проверки невыполнимости
+    group_sizes: Dict[str, int] = {}
+    for name in group_of:
+        if name is not None:
+            group_sizes[name] = group_sizes.get(name, 0) + 1
+    for name, size in group_sizes.items():
+        if size > n - size:
+            raise DrawInfeasible(
+                f"В команде «{name}» {size} из {n} участников — им не хватит получателей из других команд"
+            )
+    for i in range(n):
+        same_group = group_sizes[group_of[i]] - 1 if group_of[i] is not None else 0
+        # Оценка снизу: если даже она оставляет кандидатов, точный подсчёт не нужен
+        if n - 1 - len(banned[i]) - same_group <= 0 and not any(allowed(i, r) for r in range(n)):
+            raise DrawInfeasible(f"Участнику {user_ids[i]} некому дарить при заданных исключениях")
+    
+    # 1. Случайный круг: при редких ограничениях почти всегда находится сразу
+    order = list(range(n))
+    for _ in range(DRAW_CYCLE_ATTEMPTS):
+        random.shuffle(order)
+        if all(allowed(order[i], order[(i + 1) % n]) for i in range(n)):
+            return {user_ids[order[i]]: user_ids[order[(i + 1) % n]] for i in range(n)}
+    
+    # 2. Паросочетание дарителей и получателей
+    match_g = [-1] * n  # giver -> receiver
+    match_r = [-1] * n  # receiver -> giver
+    
+    free = list(range(n))
+    random.shuffle(free)
+    givers = list(range(n))
+    random.shuffle(givers)
+    # Самых ограниченных дарителей обслуживаем первыми, пока выбор ещё есть
+    givers.sort(key=lambda g: len(banned[g]) + (group_sizes[group_of[g]] if group_of[g] is not None else 0),
+                reverse=True)
+    for g in givers:
+        for _ in range(min(DRAW_GREEDY_PROBES, len(free))):
+            pos = random.randrange(len(free))
+            r = free[pos]
+            if allowed(g, r):
+                match_g[g], match_r[r] = r, g
+                free[pos] = free[-1]
+                free.pop()
+                break
+    
+    def augment_phase() -> int:
+        # Одна фаза в духе Хопкрофта–Карпа: общий BFS от всех свободных дарителей
+        # по дополнению графа запретов, затем непересекающиеся увеличивающие пути
+        # по дереву поиска. Непосещённые получатели разложены по командам:
+        # даритель не просматривает свою команду, опустевшие корзины выкидываются,
+        # так что каждый получатель посещается один раз, а лишние проверки
+        # оплачиваются только записями из banned.
+        buckets: Dict[Optional[str], set] = {}
+        for r, u in enumerate(user_ids):
+            buckets.setdefault(group_of[r], set()).add(u)
+        parent: Dict[int, int] = {}
+        found = []
+        queue = [g for g in range(n) if match_g[g] == -1]
+        for g in queue:
+            own = group_of[g]
+            for name in list(buckets):
+                if name is not None and name == own:
+                    continue
+                bucket = buckets[name]
+                hits = bucket - banned[g]
+                hits.discard(user_ids[g])
+                if not hits:
+                    continue
+                bucket -= hits
+                if not bucket:
+                    del buckets[name]
+                for u in hits:
+                    r = index[u]
+                    parent[r] = g
+                    if match_r[r] == -1:
+                        found.append(r)
+                    else:
+                        queue.append(match_r[r])
+            if not buckets:
+                break
+        
+        used = set()
+        augmented = 0
+        for r in found:
+            path = []
+            while True:
+                g = parent[r]
+                if g in used:
+                    path = None
+                    break
+                path.append((g, r))
+                if match_g[g] == -1:
+                    break
+                r = match_g[g]
+            if path is None:
+                continue
+            for g, r in path:
+                used.add(g)
+                match_g[g], match_r[r] = r, g
+            augmented += 1
+        return augmented
+    
+    unmatched = match_g.count(-1)
+    while unmatched:
+        augmented = augment_phase()
+        if not augmented:
+            raise DrawInfeasible(_explain_infeasible(user_ids, banned, group_of, match_g, match_r))
+        unmatched -= augmented
+    
+    return {user_ids[g]: user_ids[match_g[g]] for g in range(n)}
+
+def _explain_infeasible(user_ids: List[str], banned: List[set], group_of: List[Optional[str]],
+                        match_g: List[int], match_r: List[int]) -> str:
+    """Причина провала для сообщения: сначала ищем получателя, которому никто не может дарить"""
+    for r in range(len(user_ids)):
+        if match_r[r] != -1:
+            continue
+        receiver = user_ids[r]
+        if not any(g != r and receiver not in banned[g] and (group_of[g] is None or group_of[g] != group_of[r])
+                   for g in range(len(user_ids))):
+            return f"Участнику {receiver} никто не может дарить при заданных исключениях"
+    g = match_g.index(-1)
+    return f"Не удалось подобрать пары: ограничения слишком плотные (участник {user_ids[g]})"
+
+# === ФУНКЦИИ ===
+def sanitize_input(text: str, max_length: int = 1000) -> str:
+    """Очищает пользовательский ввод от потенциально опасных символов"""
+    if not text:
+        return ""
+    
+    # Убираем потенциально опасные символы
+    import re
+    sanitized = re.sub(r'[<>"\';]', '', str(text)[:max_length])
+    return sanitized.strip()
+
+async def get_lang(chat_id):
+    try:
+        return (await get_chat_settings(chat_id))['lang']
+    except Exception as e:
+        logger.error("Ошибка получения языка: %s", e)
+        return 'ru'
+
+async def get_theme(chat_id):
+    try:
+        return (await get_chat_settings(chat_id))['theme']
+    except Exception as e:
+        logger.error("Ошибка получения темы: %s", e)
+        return 'christmas'
+
+# === ЛОКАЛИЗАЦИЯ ===
+LOCALES_DIR = os.getenv("LOCALES_DIR", "locales")
+FALLBACK_LANG = 'en'
+
+class TextCatalog:
+    """
+    Скомпилированные шаблоны TEXTS. Тексты без подстановок форматируются
+    один раз и дальше отдаются готовой строкой, для остальных хранится
+    связанный str.format. Дополнительные языки читаются из
+    LOCALES_DIR/<lang>.json при первом обращении, недостающие ключи
+    берутся из FALLBACK_LANG. Там же кэшируются статические клавиатуры.
+    """
+
+    def __init__(self, builtin: Dict[str, Dict[str, str]], locales_dir: str, fallback: str):
+        self._builtin = builtin
+        self.locales_dir = locales_dir
+        self.fallback = fallback
+        self._langs: Dict[str, dict] = {}
+        self._keyboards: Dict[tuple, InlineKeyboardMarkup] = {}
+
+    @staticmethod
+    def _fields(template: str) -> set:
+        return {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+
+    @classmethod
+    def _compile(cls, template: str):
+        return template.format if cls._fields(template) else template.format()
+
+    def _path(self, lang: str) -> str:
+        return os.path.join(self.locales_dir, f"{lang}.json")
+
+    def _load(self, lang: str) -> dict:
+        if lang in self._builtin:
+            return {key: self._compile(template) for key, template in self._builtin[lang].items()}
+        
+        base = self.table(self.fallback)
+        try:
+            with open(self._path(lang), encoding='utf-8') as f:
+                templates = json.load(f)
+        except FileNotFoundError:
+            logger.warning(f"Язык {lang} не найден, используется {self.fallback}")
+            return base
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось загрузить язык {lang}: {e}")
+            return base
+        
+        table = dict(base)
+        reference = self._builtin[self.fallback]
+        for key, template in templates.items():
+            # Шаблон с чужими подстановками упал бы при отправке — оставляем запасной
+            if key in reference and isinstance(template, str) and self._fields(template) <= self._fields(reference[key]):
+                table[key] = self._compile(template)
+            else:
+                logger.warning(f"Язык {lang}: пропущен ключ {key}")
+        logger.info(f"Загружен язык {lang}: {len(templates)} строк")
+        return table
+
+    def table(self, lang: str) -> dict:
+        table = self._langs.get(lang)
+        if table is None:
+            table = self._langs[lang] = self._load(lang)
+        return table
+
+    def text(self, key: str, lang: str, **kwargs) -> str:
+        entry = self.table(lang)[key]
+        if type(entry) is str:
+            return entry
+        return entry(**kwargs)
+
+    def available(self, lang: str) -> bool:
+        return lang in self._builtin or (lang.isalpha() and os.path.isfile(self._path(lang)))
+
+    def keyboard(self, key: tuple, build) -> InlineKeyboardMarkup:
+        """Клавиатура собирается build() при первом запросе и дальше переиспользуется"""
+        markup = self._keyboards.get(key)
+        if markup is None:
+            markup = self._keyboards[key] = build()
+        return markup
+
+texts = TextCatalog(TEXTS, LOCALES_DIR, FALLBACK_LANG)
+# Без обёртки-функции: лишний вызов с перепаковкой kwargs стоит дороже самого format
+get_text = texts.text
+
+# Лимит Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+
+def _tg_len(text: str) -> int:
+    # Telegram считает длину в UTF-16: эмодзи занимают по две позиции
+    return len(text.encode('utf-16-le')) // 2
+
+def split_message(header: str, lines: List[str], limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Собирает header и строки в сообщения не длиннее limit, разбивая по границам строк"""
+    chunks = []
+    current = [header] if header else []
+    size = _tg_len(header)
+    for line in lines:
+        line = line[:limit // 2 - 1]
+        length = _tg_len(line) + 1
+        if current and size + length > limit:
+            chunks.append("".join(current).rstrip("\n"))
+            current, size = [], 0
+        current.append(line + "\n")
+        size += length
+    if current:
+        chunks.append("".join(current).rstrip("\n"))
+    return chunks
+
+NICK_PREFIXES = {
+    'christmas': ["Санта", "Эльф", "Мороз", "Подарок", "Новогодик", "Снежок", "Олень", "Елочка"],
+    'halloween': ["Призрак", "Ведьма", "Тыква", "Летучая Мышь", "Паук", "Скелет", "Вампир", "Оборотень"],
+    'office': ["Кофе", "Принтер", "Папка", "Степлер", "Монитор", "Стол", "Стул", "Лампа"]
+}
+
+class NickAllocator:
+    """
+    Раздаёт уникальные ники обходом пространства ников чата в псевдослучайном
+    порядке: курсор k даёт кандидата (offset + k * stride) mod N, stride взаимно
+    прост с N, поэтому каждый ник встречается ровно один раз. Занятые ники
+    пропускаются по множеству used, так что выдача — амортизированно O(1) без
+    проверок в базе и без хранения списка свободных ников. Когда пространство
+    исчерпано, оно расширяется суффиксами большей длины (01..98 → 100..999 → ...).
+    Пулы живут в LRU на maxsize чатов: вытесненный пул перечитывается из базы.
+    Вызывается только из потока БД, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self._pools: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    @staticmethod
+    def _space(width: int) -> tuple:
+        """(первый суффикс, число суффиксов) для суффиксов длины width"""
+        if width == 2:
+            return 1, 98
+        return 10 ** (width - 1), 9 * 10 ** (width - 1)
+
+    @classmethod
+    def _candidate(cls, pool: Dict[str, Any], index: int) -> str:
+        first, count = cls._space(pool['width'])
+        return pool['prefixes'][index // count] + str(first + index % count).zfill(pool['width'])
+
+    def _widen(self, pool: Dict[str, Any]):
+        pool['width'] = max(pool['width'] + 1, 2)
+        size = len(pool['prefixes']) * self._space(pool['width'])[1]
+        stride = random.randrange(1, size)
+        while math.gcd(stride, size) != 1:
+            stride = random.randrange(1, size)
+        pool.update(size=size, stride=stride, offset=random.randrange(size), cursor=0)
+
+    def _load(self, db: sqlite3.Connection, chat_id: str, theme: str) -> Dict[str, Any]:
+        used = {row[0] for row in db.execute('SELECT nick FROM players WHERE chat_id = ?', (chat_id,))}
+        pool = {
+            'theme': theme,
+            'prefixes': NICK_PREFIXES.get(theme, NICK_PREFIXES['christmas']),
+            'width': 0,
+            'size': 0,
+            'cursor': 0,
+            'used': used,
+        }
+        self._pools[chat_id] = pool
+        while len(self._pools) > self.maxsize:
+            self._pools.popitem(last=False)
+        return pool
+
+    def allocate(self, db: sqlite3.Connection, chat_id: str, theme: str) -> str:
+        pool = self._pools.get(chat_id)
+        if pool is None or pool['theme'] != theme:
+            pool = self._load(db, chat_id, theme)
+        else:
+            self._pools.move_to_end(chat_id)
+        
+        used = pool['used']
+        while True:
+            if pool['cursor'] >= pool['size']:
+                self._widen(pool)
+            index = (pool['offset'] + pool['cursor'] * pool['stride']) % pool['size']
+            pool['cursor'] += 1
+            nick = self._candidate(pool, index)
+            if nick not in used:
+                used.add(nick)
+                return nick
+
+    def forget(self, chat_id: str):
+        """Сбрасывает пул чата — он будет перечитан из базы при следующей выдаче"""
+        self._pools.pop(chat_id, None)
+
+nick_allocator = NickAllocator(maxsize=int(os.getenv("NICK_POOL_CACHE_SIZE", "1000")))
+
+# Сколько раз пробуем вставить игрока, если ник внезапно оказался занят
+NICK_INSERT_ATTEMPTS = 3
+
+class AdminRoster:
+    """
+    Кэш администраторов чатов для всех админских команд. Список грузится
+    одним get_chat_administrators на чат (параллельные запросы ждут одну
+    загрузку), живёт ttl секунд и поправляется по апдейтам chat_member.
+    """
 
-# === ФУНКЦИИ ===
-def sanitize_input(text: str, max_length: int = 1000) -> str:
-    """Очищает пользовательский ввод от потенциально опасных символов"""
-    if not text:
-        return ""
-    
-    # Убираем потенциально опасные символы
-    import re
-    sanitized = re.sub(r'[<>"\';]', '', str(text)[:max_length])
-    return sanitized.strip()
+    def __init__(self, ttl: float = 600):
+        self.ttl = ttl
+        self._data: Dict[int, tuple] = {}
+        self._loading: Dict[int, asyncio.Task] = {}
 
-def get_lang(chat_id):
-    try:
-        with get_db() as db:
-            row = db.execute('SELECT lang FROM games WHERE chat_id = ?', (str(chat_id),)).fetchone()
-            return row['lang'] if row else 'ru'
-    except Exception as e:
-        logger.error(f"Ошибка получения языка: {e}")
-        return 'ru'
+    async def get(self, chat_id: int) -> set:
+        entry = self._data.get(chat_id)
+        if entry is not None and entry[0] >= time.monotonic():
+            return entry[1]
+        task = self._loading.get(chat_id)
+        if task is None:
+            task = self._loading[chat_id] = asyncio.create_task(self._load(chat_id))
+            task.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return await asyncio.shield(task)
 
-def get_theme(chat_id):
-    try:
-        with get_db() as db:
-            row = db.execute('SELECT theme FROM games WHERE chat_id = ?', (str(chat_id),)).fetchone()
-            return row['theme'] if row else 'christmas'
-    except Exception as e:
-        logger.error(f"Ошибка получения темы: {e}")
-        return 'christmas'
+    async def _load(self, chat_id: int) -> set:
+        admins = await bot.get_chat_administrators(chat_id)
+        ids = {member.user.id for member in admins}
+        self._data[chat_id] = (time.monotonic() + self.ttl, ids)
+        return ids
 
-def get_text(key, lang, **kwargs):
-    return TEXTS[lang][key].format(**kwargs)
+    def apply(self, chat_id: int, user_id: int, is_admin: bool):
+        """Поправка по chat_member: права выдали или отобрали"""
+        entry = self._data.get(chat_id)
+        if entry is None:
+            return
+        if is_admin:
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
 
-def generate_nick(theme):
-    """Генерирует случайный ник на основе темы"""
-    base_nicks = {
-        'christmas': ["Санта", "Эльф", "Мороз", "Подарок", "Новогодик", "Снежок", "Олень", "Елочка"],
-        'halloween': ["Призрак", "Ведьма", "Тыква", "Летучая Мышь", "Паук", "Скелет", "Вампир", "Оборотень"],
-        'office': ["Кофе", "Принтер", "Папка", "Степлер", "Монитор", "Стол", "Стул", "Лампа"]
-    }
-    
-    prefixes = base_nicks.get(theme, base_nicks['christmas'])
-    suffixes = [str(i).zfill(2) for i in range(1, 99)]
-    return random.choice(prefixes) + random.choice(suffixes)
+    def invalidate(self, chat_id: int):
+        self._data.pop(chat_id, None)
+
+admin_roster = AdminRoster(ttl=float(os.getenv("ADMIN_CACHE_TTL", "600")))
 
 async def is_admin(chat_id: int, user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором чата"""
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        return isinstance(member, (ChatMemberOwner, ChatMemberAdministrator))
+        return user_id in await admin_roster.get(chat_id)
     except Exception as e:
         logger.error(f"Ошибка проверки прав администратора: {e}")
         return False
 
-async def register_user(user_id: str, chat_id: str, full_name: str, theme: str = 'christmas'):
-    """Регистрирует отдельного пользователя в игре"""
-    try:
-        with get_db() as db:
-            # Проверяем, уже ли зарегистрирован
-            existing = db.execute('SELECT 1 FROM players WHERE user_id = ? AND chat_id = ?', (user_id, chat_id)).fetchone()
-            if existing:
-                return False  # Уже зарегистрирован
-            
-            nick = generate_nick(theme)
-            # Проверяем, что ник уникальный
-            while db.execute('SELECT 1 FROM players WHERE nick = ? AND chat_id = ?', (nick, chat_id)).fetchone():
-                nick = generate_nick(theme)
-            
+def _register_user_tx(db: sqlite3.Connection, user_id: str, chat_id: str, full_name: str, theme: str) -> Optional[str]:
+    # Проверяем, уже ли зарегистрирован
+    existing = db.execute('SELECT 1 FROM players WHERE user_id = ? AND chat_id = ?', (user_id, chat_id)).fetchone()
+    if existing:
+        return None  # Уже зарегистрирован
+    
+    for _ in range(NICK_INSERT_ATTEMPTS):
+        nick = nick_allocator.allocate(db, chat_id, theme)
+        try:
             db.execute('''
                 INSERT INTO players (user_id, chat_id, full_name, nick)
                 VALUES (?, ?, ?, ?)
             ''', (user_id, chat_id, full_name, nick))
-            
-            logger.info(f"Пользователь {full_name} ({user_id}) зарегистрирован в игре {chat_id} с ником {nick}")
-            return True
+            return nick
+        except sqlite3.IntegrityError:
+            # Ник занят в обход аллокатора (например, другим процессом) — перечитываем пул
+            nick_allocator.forget(chat_id)
+    raise RuntimeError(f"Не удалось выделить уникальный ник в чате {chat_id}")
+
+def _register_users_tx(db: sqlite3.Connection, chat_id: str, users: List[tuple], theme: str) -> List[tuple]:
+    """Массовая регистрация одной вставкой; возвращает [(user_id, full_name, nick)] новых участников"""
+    seen = {row[0] for row in db.execute('SELECT user_id FROM players WHERE chat_id = ?', (chat_id,))}
+    new = []
+    for user_id, full_name in users:
+        if user_id not in seen:
+            seen.add(user_id)
+            new.append((user_id, full_name))
+    if not new:
+        return []
+    
+    for _ in range(NICK_INSERT_ATTEMPTS):
+        rows = [(user_id, chat_id, full_name, nick_allocator.allocate(db, chat_id, theme)) for user_id, full_name in new]
+        # Точка сохранения: при конфликте ника откатываем только эту вставку, а не всю транзакцию
+        db.execute('SAVEPOINT bulk_register')
+        try:
+            db.executemany('INSERT INTO players (user_id, chat_id, full_name, nick) VALUES (?, ?, ?, ?)', rows)
+            db.execute('RELEASE bulk_register')
+            return [(user_id, full_name, nick) for user_id, _, full_name, nick in rows]
+        except sqlite3.IntegrityError:
+            db.execute('ROLLBACK TO bulk_register')
+            db.execute('RELEASE bulk_register')
+            nick_allocator.forget(chat_id)
+    raise RuntimeError(f"Не удалось выделить уникальные ники в чате {chat_id}")
+
+async def register_users(chat_id: str, users: List[tuple], theme: str = 'christmas') -> List[tuple]:
+    """Регистрирует список (user_id, full_name) одной транзакцией"""
+    added = await storage.run(_register_users_tx, chat_id, users, theme)
+    for user_id, _, nick in added:
+        membership.add_member(chat_id, user_id)
+        nick_roster.add(chat_id, user_id, nick)
+        leaderboard_cache.add_player(chat_id, user_id, nick)
+    logger.info("Массово зарегистрировано %s из %s участников в игре %s", len(added), len(users), chat_id)
+    return added
+
+async def register_user(user_id: str, chat_id: str, full_name: str, theme: str = 'christmas') -> Optional[str]:
+    """Регистрирует отдельного пользователя в игре, возвращает выданный ник"""
+    try:
+        nick = await storage.run(_register_user_tx, user_id, chat_id, full_name, theme)
+        membership.add_member(chat_id, user_id)
+        if nick is None:
+            return None
+        nick_roster.add(chat_id, user_id, nick)
+        leaderboard_cache.add_player(chat_id, user_id, nick)
+        
+        activity_logger.info("Пользователь %s (%s) зарегистрирован в игре %s с ником %s", full_name, user_id, chat_id, nick)
+        return nick
     except Exception as e:
-        logger.error(f"Ошибка регистрации пользователя {user_id}: {e}")
-        return False
+        logger.error("Ошибка регистрации пользователя %s: %s", user_id, e)
+        return None
 
 async def auto_register_from_activity(chat_id: str, theme: str = 'christmas'):
     """
@@ -302,25 +2257,19 @@ async def auto_register_from_activity(chat_id: str, theme: str = 'christmas'):
     Отправляет сообщение с призывом к участию.
     """
     try:
-        with get_db() as db:
-            # Подсчитываем текущих зарегистрированных участников
-            result = db.execute('SELECT COUNT(*) as cnt FROM players WHERE chat_id = ?', (chat_id,)).fetchone()
-            count = result['cnt'] if result else 0
+        # Подсчитываем текущих зарегистрированных участников
+        result = await storage.fetchone('SELECT COUNT(*) as cnt FROM players WHERE chat_id = ?', (chat_id,))
+        count = result['cnt'] if result else 0
         
-        lang = get_lang(chat_id)
-        message = get_text('auto_register_call', lang).format(count=count)
+        lang = await get_lang(chat_id)
+        message = get_text('auto_register_call', lang, count=count)
         
         # Отправляем сообщение с кнопкой для регистрации
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎄 Участвовать в игре", callback_data="join_game")]
-        ])
-        
-        await bot.send_message(chat_id, message, reply_markup=kb)
-        logger.info(f"Отправлен призыв к участию в чат {chat_id}")
+        await bot.send_message(chat_id, message, reply_markup=join_keyboard())
+        logger.info("Отправлен призыв к участию в чат %s", chat_id)
         return count
     except Exception as e:
-        logger.error(f"Ошибка автоматической регистрации через активность: {e}")
-        logger.error(f"Детали ошибки: {traceback.format_exc()}")
+        logger.error("Ошибка автоматической регистрации через активность: %s", e, exc_info=True)
         return 0
 
 # === УСТАНОВКА КОМАНД В МЕНЮ ===
@@ -329,7 +2278,10 @@ async def set_bot_commands():
         {"command": "start", "description": "Запустить бота"},
         {"command": "help", "description": "Помощь по игре"},
         {"command": "setup", "description": "Настроить игру"},
+        {"command": "import", "description": "Импорт участников"},
         {"command": "mygift", "description": "Указать желание"},
+        {"command": "couple", "description": "Не дарить друг другу"},
+        {"command": "team", "description": "Указать команду"},
         {"command": "santabingo", "description": "Угадать личность"},
         {"command": "leaderboard", "description": "Таблица лидеров"},
         {"command": "premium", "description": "Премиум-ники"},
@@ -338,23 +2290,163 @@ async def set_bot_commands():
     ]
     await bot.set_my_commands(commands)
 
+# === ПЛАНИРОВЩИК ===
+# Насколько поздно ещё можно выполнить пропущенную задачу (например, после простоя)
+JOB_MISFIRE_GRACE = int(os.getenv("JOB_MISFIRE_GRACE", str(7 * 24 * 3600)))
+# В планировщик загружаются только задачи на ближайший горизонт, остальные ждут в базе
+JOB_LOAD_HORIZON = int(os.getenv("JOB_LOAD_HORIZON", "3600"))
+# Сколько раз задачу, прерванную падением процесса, можно запустить заново
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+def _scheduler_now() -> datetime:
+    # Даты из /setup — "настенное" время в часовом поясе планировщика
+    return datetime.now(scheduler.timezone).replace(tzinfo=None)
+
+def _add_scheduler_job(job_id: str, kind: str, chat_id: str, run_at: int, catch_up: bool = False):
+    run_date = datetime.fromtimestamp(run_at)
+    if catch_up:
+        # Задача из базы, срок которой прошёл во время простоя, — выполняем сразу
+        run_date = max(run_date, _scheduler_now())
+    scheduler.add_job(
+        run_game_job, 'date', run_date=run_date, args=[kind, chat_id, run_at],
+        id=job_id, replace_existing=True,
+        misfire_grace_time=JOB_MISFIRE_GRACE, coalesce=True
+    )
+
+async def schedule_game_job(kind: str, chat_id: str, run_at: int):
+    """Сохраняет задачу draw/reveal в базе и ставит её в планировщик, если она скоро"""
+    job_id = f"{kind}:{chat_id}"
+    await storage.execute(
+        "INSERT OR REPLACE INTO scheduled_jobs (job_id, kind, chat_id, run_at, status) VALUES (?, ?, ?, ?, 'pending')",
+        (job_id, kind, chat_id, run_at)
+    )
+    horizon = (_scheduler_now() + timedelta(seconds=JOB_LOAD_HORIZON)).timestamp()
+    if run_at <= horizon:
+        _add_scheduler_job(job_id, kind, chat_id, run_at)
+    elif scheduler.get_job(job_id):
+        # Задачу перенесли на более позднее время — её подхватит load_due_jobs
+        scheduler.remove_job(job_id)
+
+async def run_game_job(kind: str, chat_id: str, run_at: int):
+    job_id = f"{kind}:{chat_id}"
+    # Захват одним UPDATE: повторный запуск той же задачи (load_due_jobs, другой процесс) ничего не сделает
+    claimed = await storage.execute(
+        "UPDATE scheduled_jobs SET status = 'running', attempts = attempts + 1 "
+        "WHERE job_id = ? AND run_at = ? AND status = 'pending'",
+        (job_id, run_at)
+    )
+    if not claimed:
+        return  # Задача уже выполнена, выполняется или перенесена
+    
+    labels = (('kind', kind),)
+    # run_at — "настенное" время планировщика, как и в _add_scheduler_job
+    lag = (_scheduler_now() - datetime.fromtimestamp(run_at)).total_seconds()
+    metrics.observe("santa_job_lag_seconds", labels, max(lag, 0))
+    started = time.perf_counter()
+    status, error = 'failed', None
+    try:
+        if kind == 'draw':
+            await do_draw(chat_id)
+        else:
+            await finish_game(chat_id)
+        status = 'done'
+    except Exception as e:
+        # Не возвращаем задачу в pending: жеребьёвка могла успеть записать пары и поставить рассылку
+        error = str(e)[:500]
+        logger.error("Задача %s завершилась ошибкой: %s", job_id, e, exc_info=True)
+    finally:
+        metrics.observe("santa_job_seconds", labels, time.perf_counter() - started)
+        await storage.execute(
+            "UPDATE scheduled_jobs SET status = ?, error = ? WHERE job_id = ? AND run_at = ? AND status = 'running'",
+            (status, error, job_id, run_at)
+        )
+
+def _recover_running_jobs_tx(db: sqlite3.Connection, max_attempts: int) -> tuple:
+    # Задачи в 'running' после старта — прерваны падением процесса
+    rows = [
+        row for row in db.execute("SELECT job_id, chat_id, attempts FROM scheduled_jobs WHERE status = 'running'")
+        if owns_chat(row['chat_id'])
+    ]
+    retry = [(row['job_id'],) for row in rows if row['attempts'] < max_attempts]
+    give_up = [(row['job_id'],) for row in rows if row['attempts'] >= max_attempts]
+    db.executemany("UPDATE scheduled_jobs SET status = 'pending' WHERE job_id = ? AND status = 'running'", retry)
+    db.executemany(
+        "UPDATE scheduled_jobs SET status = 'failed', error = 'прервана, попытки исчерпаны' "
+        "WHERE job_id = ? AND status = 'running'",
+        give_up
+    )
+    return len(retry), len(give_up)
+
+def _load_due_jobs_tx(db: sqlite3.Connection, missed_before: int, due_before: int):
+    missed = db.execute(
+        "UPDATE scheduled_jobs SET status = 'missed' WHERE status = 'pending' AND run_at < ?",
+        (missed_before,)
+    ).rowcount
+    due = db.execute(
+        "SELECT job_id, kind, chat_id, run_at FROM scheduled_jobs WHERE status = 'pending' AND run_at <= ?",
+        (due_before,)
+    ).fetchall()
+    return missed, due
+
+async def load_due_jobs():
+    """Переносит из базы в планировщик задачи ближайшего горизонта"""
+    now = _scheduler_now()
+    missed_before = int((now - timedelta(seconds=JOB_MISFIRE_GRACE)).timestamp())
+    due_before = int((now + timedelta(seconds=JOB_LOAD_HORIZON)).timestamp())
+    missed, due = await storage.run(_load_due_jobs_tx, missed_before, due_before)
+    if missed:
+        logger.warning(f"Пропущено задач планировщика (старше допустимой задержки): {missed}")
+    
+    loaded = 0
+    for row in due:
+        if not owns_chat(row['chat_id']) or scheduler.get_job(row['job_id']):
+            continue
+        _add_scheduler_job(row['job_id'], row['kind'], row['chat_id'], row['run_at'], catch_up=True)
+        loaded += 1
+    return loaded
+
+def _seed_jobs_from_games(db: sqlite3.Connection, now: int):
+    # Игры, настроенные до появления scheduled_jobs: восстанавливаем только будущие даты
+    db.execute('''
+        INSERT OR IGNORE INTO scheduled_jobs (job_id, kind, chat_id, run_at)
+        SELECT 'draw:' || chat_id, 'draw', chat_id, draw_time FROM games WHERE draw_time > ?
+    ''', (now,))
+    db.execute('''
+        INSERT OR IGNORE INTO scheduled_jobs (job_id, kind, chat_id, run_at)
+        SELECT 'reveal:' || chat_id, 'reveal', chat_id, end_time FROM games WHERE end_time > ?
+    ''', (now,))
+
+async def rehydrate_jobs():
+    """Восстанавливает задачи жеребьёвки и раскрытия после рестарта"""
+    started = time.monotonic()
+    retried, failed = await storage.run(_recover_running_jobs_tx, JOB_MAX_ATTEMPTS)
+    if retried or failed:
+        logger.warning(f"Прерванные задачи планировщика: {retried} перезапущено, {failed} отмечено failed")
+    await storage.run(_seed_jobs_from_games, int(_scheduler_now().timestamp()))
+    loaded = await load_due_jobs()
+    scheduler.add_job(
+        load_due_jobs, 'interval', seconds=max(JOB_LOAD_HORIZON // 2, 1),
+        id='load_due_jobs', replace_existing=True, coalesce=True
+    )
+    logger.info(f"Восстановлено задач планировщика: {loaded} за {time.monotonic() - started:.3f} с")
+
 # === ХЕНДЛЕРЫ ===
 @dp.message(Command("start"))
 async def start(message: Message):
-    lang = get_lang(message.chat.id)
-    kb = [
+    lang = await get_lang(message.chat.id)
+    kb = texts.keyboard(('start',), lambda: InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🌟 Поддержать", pay=True)],
-        [InlineKeyboardButton(text="ℹ️ Помощь", callback_data="help")]
-    ]
+        [InlineKeyboardButton(text="ℹ️ Помощь", callback_data=pack_callback(CB_HELP))]
+    ]))
     await message.answer(
         get_text('start', lang),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
+        reply_markup=kb,
         parse_mode=ParseMode.MARKDOWN
     )
 
-@dp.callback_query(F.data == "help")
+@dp.callback_query(CallbackKind(CB_HELP))
 async def help(callback):
-    lang = get_lang(callback.message.chat.id)
+    lang = await get_lang(callback.message.chat.id)
     await callback.message.edit_text(
         get_text('help', lang),
         parse_mode=ParseMode.MARKDOWN
@@ -372,23 +2464,28 @@ async def setup(message: Message, state: FSMContext):
         await message.reply("❌ Только администраторы могут настраивать игру.")
         return
     
-    lang = get_lang(message.chat.id)
-    kb = [
-        [InlineKeyboardButton(text="🎄 Рождество", callback_data="theme_christmas")],
-        [InlineKeyboardButton(text="🎃 Хэллоуин", callback_data="theme_halloween")],
-        [InlineKeyboardButton(text="👔 Корпоратив", callback_data="theme_office")]
-    ]
-    await message.reply(get_text('setup_intro', lang), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    lang = await get_lang(message.chat.id)
+    kb = texts.keyboard(('themes',), lambda: InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎄 Рождество", callback_data=pack_callback(CB_THEME, THEMES.index('christmas')))],
+        [InlineKeyboardButton(text="🎃 Хэллоуин", callback_data=pack_callback(CB_THEME, THEMES.index('halloween')))],
+        [InlineKeyboardButton(text="👔 Корпоратив", callback_data=pack_callback(CB_THEME, THEMES.index('office')))]
+    ]))
+    await message.reply(get_text('setup_intro', lang), reply_markup=kb)
     await state.set_state(SetupState.choosing_theme)
 
-@dp.callback_query(F.data.startswith("theme_"))
-async def set_theme(callback, state: FSMContext):
-    theme = callback.data.split("_")[1]
+@dp.callback_query(CallbackKind(CB_THEME))
+async def set_theme(callback, state: FSMContext, cb_args: tuple):
+    if not 0 <= cb_args[0] < len(THEMES):
+        await callback.answer()
+        return
+    theme = THEMES[cb_args[0]]
     chat_id = str(callback.message.chat.id)
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
     
-    with get_db() as db:
-        db.execute('INSERT OR REPLACE INTO games (chat_id, theme) VALUES (?, ?)', (chat_id, theme))
+    await storage.execute('INSERT OR REPLACE INTO games (chat_id, theme) VALUES (?, ?)', (chat_id, theme))
+    # INSERT OR REPLACE сбрасывает остальные поля к значениям по умолчанию
+    settings_cache.invalidate(chat_id)
+    membership.add_game(chat_id)
     
     # Призываем участников к регистрации через активность
     registered_count = await auto_register_from_activity(chat_id, theme)
@@ -402,12 +2499,16 @@ async def set_draw(message: Message, state: FSMContext):
         dt = datetime.strptime(message.text, "%d.%m.%Y %H:%M")
         timestamp = int(dt.timestamp())
         chat_id = str(message.chat.id)
-        lang = get_lang(chat_id)
+        lang = await get_lang(chat_id)
+        if dt <= _scheduler_now():
+            # Дата в прошлом (например, не тот год) запустила бы жеребьёвку сразу
+            await message.reply(get_text('invalid_date', lang))
+            return
         
-        with get_db() as db:
-            db.execute('UPDATE games SET draw_time = ? WHERE chat_id = ?', (timestamp, chat_id))
+        if await storage.execute('UPDATE games SET draw_time = ? WHERE chat_id = ?', (timestamp, chat_id)):
+            settings_cache.update(chat_id, draw_time=timestamp)
         
-        scheduler.add_job(do_draw, 'date', run_date=dt, args=[chat_id])
+        await schedule_game_job('draw', chat_id, timestamp)
         await message.reply(get_text('draw_set', lang, time=message.text))
         await message.reply(get_text('setup_prompt_reveal', lang))
         await state.set_state(SetupState.waiting_reveal)
@@ -420,83 +2521,268 @@ async def set_reveal(message: Message, state: FSMContext):
         dt = datetime.strptime(message.text, "%d.%m.%Y %H:%M")
         timestamp = int(dt.timestamp())
         chat_id = str(message.chat.id)
-        lang = get_lang(chat_id)
+        lang = await get_lang(chat_id)
+        if dt <= _scheduler_now():
+            # Дата в прошлом (например, не тот год) запустила бы раскрытие сразу
+            await message.reply(get_text('invalid_date', lang))
+            return
         
-        with get_db() as db:
-            db.execute('UPDATE games SET end_time = ? WHERE chat_id = ?', (timestamp, chat_id))
+        if await storage.execute('UPDATE games SET end_time = ? WHERE chat_id = ?', (timestamp, chat_id)):
+            settings_cache.update(chat_id, end_time=timestamp)
         
-        scheduler.add_job(finish_game, 'date', run_date=dt, args=[chat_id])
+        await schedule_game_job('reveal', chat_id, timestamp)
         await message.reply(get_text('reveal_set', lang, time=message.text))
         await state.clear()
     except:
         await message.reply(get_text('invalid_date', lang))
 
+def _load_draw_constraints(db: sqlite3.Connection, chat_id: str):
+    exclusions: Dict[str, set] = {}
+    for row in db.execute('SELECT giver_id, receiver_id FROM draw_exclusions WHERE chat_id = ?', (chat_id,)):
+        exclusions.setdefault(row['giver_id'], set()).add(row['receiver_id'])
+    groups = {
+        row['user_id']: row['group_name']
+        for row in db.execute('SELECT user_id, group_name FROM draw_groups WHERE chat_id = ?', (chat_id,))
+    }
+    return exclusions, groups
+
+def format_draw_message(nick: str, gift: Optional[str]) -> str:
+    msg = f"🎁 Ваш получатель подарка: {nick}\n"
+    if gift:
+        msg += f"📝 Их желание: {gift}"
+    else:
+        msg += "📝 Желание пока не указано"
+    return msg
+
 async def do_draw(chat_id):
     """Проводит жеребьевку и назначает участников"""
     try:
-        with get_db() as db:
-            players = db.execute('SELECT user_id FROM players WHERE chat_id = ?', (chat_id,)).fetchall()
-            if len(players) < 2:  # Минимум 2 участника
-                await bot.send_message(chat_id, "❌ Недостаточно участников для жеребьевки (минимум 2)")
-                return
-            
-            user_ids = [p['user_id'] for p in players]
-            random.shuffle(user_ids)
-            
-            # Назначаем получателей подарков
-            for i in range(len(user_ids)):
-                giver = user_ids[i]
-                receiver = user_ids[(i + 1) % len(user_ids)]
-                db.execute('UPDATE players SET target_id = ? WHERE user_id = ? AND chat_id = ?', (receiver, giver, chat_id))
-            
-            # Отправляем уведомления участникам
-            for i in range(len(user_ids)):
-                try:
-                    target = db.execute('''
-                        SELECT p.nick, p.gift FROM players p
-                        WHERE p.user_id = ? AND p.chat_id = ?
-                    ''', (user_ids[(i + 1) % len(user_ids)], chat_id)).fetchone()
-                    
-                    msg = f"🎁 Ваш получатель подарка: {target['nick']}\n"
-                    if target['gift']:
-                        msg += f"📝 Их желание: {target['gift']}"
-                    else:
-                        msg += "📝 Желание пока не указано"
-                    
-                    await bot.send_message(user_ids[i], msg)
-                except Exception as e:
-                    logger.error(f"Ошибка отправки сообщения пользователю {user_ids[i]}: {e}")
-            
-            lang = get_lang(chat_id)
-            await bot.send_message(chat_id, get_text('draw_done', lang))
-            logger.info(f"Жеребьевка завершена для чата {chat_id}")
+        players = await storage.fetchall('SELECT user_id, nick, gift, target_id FROM players WHERE chat_id = ?', (chat_id,))
+        if len(players) < 2:  # Минимум 2 участника
+            await bot.send_message(chat_id, "❌ Недостаточно участников для жеребьевки (минимум 2)")
+            return
+        
+        exclusions, groups = await storage.run(_load_draw_constraints, chat_id)
+        with_previous = {giver: set(receivers) for giver, receivers in exclusions.items()}
+        for p in players:
+            if p['target_id']:
+                with_previous.setdefault(p['user_id'], set()).add(p['target_id'])
+        
+        # Мягкие ограничения снимаем по очереди, если иначе пар не подобрать: сначала
+        # прошлого получателя, затем команды — в команду записывается кто угодно, и
+        # команда больше половины игры не должна срывать жеребьёвку всем
+        attempts = [(with_previous, groups, None)]
+        if with_previous != exclusions:
+            attempts.append((exclusions, groups, "повтор прошлогодних пар неизбежен"))
+        if groups:
+            attempts.append((exclusions, {}, "команды не учитываются"))
+        # Пары считаем в памяти, вне event loop: для тысяч участников это заметная работа
+        user_ids = [p['user_id'] for p in players]
+        loop = asyncio.get_running_loop()
+        assignment = None
+        for banned, teams, relaxed in attempts:
+            if relaxed:
+                logger.info("Жеребьевка в чате %s: %s", chat_id, relaxed)
+            try:
+                assignment = await loop.run_in_executor(None, solve_draw, user_ids, banned, teams)
+                break
+            except DrawInfeasible as e:
+                error = e
+        if assignment is None:
+            logger.warning("Жеребьевка в чате %s невозможна: %s", chat_id, error)
+            await bot.send_message(chat_id, f"❌ Жеребьевка невозможна: {error}")
+            return
+        
+        by_id = {p['user_id']: p for p in players}
+        pairs = [(by_id[giver], by_id[receiver]) for giver, receiver in assignment.items()]
+        
+        # Назначения и уведомления пишем пакетно одной транзакцией
+        def assign(db):
+            db.executemany(
+                'UPDATE players SET target_id = ? WHERE user_id = ? AND chat_id = ?',
+                [(receiver['user_id'], giver['user_id'], chat_id) for giver, receiver in pairs]
+            )
+            # Недоставленные уведомления прошлой жеребьёвки больше не актуальны
+            db.execute("DELETE FROM outbox WHERE kind = 'draw' AND chat_id = ? AND status = 'pending'", (chat_id,))
+            messages = [(giver['user_id'], format_draw_message(receiver['nick'], receiver['gift']))
+                        for giver, receiver in pairs]
+            # В транзакции мы единственный писатель, и AUTOINCREMENT выдаёт id подряд после
+            # sqlite_sequence — id вставленных строк известны без повторного чтения outbox
+            seq = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'outbox'").fetchone()
+            first_id = (seq[0] if seq else 0) + 1
+            db.executemany(
+                "INSERT INTO outbox (kind, chat_id, recipient, text) VALUES ('draw', ?, ?, ?)",
+                [(chat_id, recipient, text) for recipient, text in messages]
+            )
+            last = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'outbox'").fetchone()
+            if last is None or last[0] != first_id + len(messages) - 1:
+                return db.execute(
+                    "SELECT id, recipient, text FROM outbox WHERE kind = 'draw' AND chat_id = ? AND status = 'pending'",
+                    (chat_id,)
+                ).fetchall()
+            return [{'id': first_id + i, 'recipient': recipient, 'text': text}
+                    for i, (recipient, text) in enumerate(messages)]
+        
+        # Рассылка идёт в фоне, соединение с базой не держим
+        broadcaster.submit(await storage.run(assign))
+        
+        lang = await get_lang(chat_id)
+        await bot.send_message(chat_id, get_text('draw_done', lang))
+        logger.info(f"Жеребьевка завершена для чата {chat_id}")
     except Exception as e:
         logger.error(f"Ошибка проведения жеребьевки: {e}")
         await bot.send_message(chat_id, "❌ Произошла ошибка во время жеребьевки")
 
+# Пороги ачивок финала: (ключ текста, минимальный счёт)
+FINAL_ACHIEVEMENTS = [('ach_guess_master', 5), ('ach_legend', 10)]
+
 async def finish_game(chat_id):
-    lang = get_lang(chat_id)
-    results = get_text('final_intro', lang)
+    lang = await get_lang(chat_id)
+    await score_buffer.flush()
     
-    with get_db() as db:
-        players = db.execute('''
-            SELECT p.user_id, p.nick, p.score, p.full_name FROM players p
+    def collect(db):
+        # Сначала выдаём ачивки, чтобы они попали в итоговое сообщение
+        db.executemany('''
+            INSERT OR IGNORE INTO achievements (chat_id, player_id, name)
+            SELECT chat_id, user_id, ? FROM players WHERE chat_id = ? AND score >= ?
+        ''', [(get_text(key, lang), chat_id, threshold) for key, threshold in FINAL_ACHIEVEMENTS])
+        
+        return db.execute('''
+            SELECT p.nick, p.score, group_concat(a.name, ', ') AS achievements
+            FROM players p
+            LEFT JOIN achievements a ON a.chat_id = p.chat_id AND a.player_id = p.user_id
             WHERE p.chat_id = ?
+            GROUP BY p.user_id
             ORDER BY p.score DESC
         ''', (chat_id,)).fetchall()
-        
-        for p in players:
-            achievements = db.execute('SELECT name FROM achievements WHERE player_id = ?', (p['user_id'],)).fetchall()
-            ach_list = ", ".join([a['name'] for a in achievements]) if achievements else "—"
-            results += f"👤 {p['nick']} | ⭐ {p['score']} | 🏆 {ach_list}\n"
-        
-        for p in players:
-            if p['score'] >= 5:
-                db.execute('INSERT OR IGNORE INTO achievements (player_id, name) VALUES (?, ?)', (p['user_id'], get_text('ach_guess_master', lang)))
-            if p['score'] >= 10:
-                db.execute('INSERT OR IGNORE INTO achievements (player_id, name) VALUES (?, ?)', (p['user_id'], get_text('ach_legend', lang)))
     
-    await bot.send_message(chat_id, results)
+    players = await storage.run(collect)
+    lines = [f"👤 {p['nick']} | ⭐ {p['score']} | 🏆 {p['achievements'] or '—'}" for p in players]
+    for chunk in split_message(get_text('final_intro', lang), lines):
+        await bot.send_message(chat_id, chunk)
+
+@dp.message(Command("couple"))
+async def couple(message: Message):
+    """Запрещает автору и участнику, на чьё сообщение он ответил, дарить друг другу"""
+    if message.chat.type not in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        await message.reply("❌ Эта команда работает только в группах.")
+        return
+    
+    reply = message.reply_to_message
+    if not reply or not reply.from_user or reply.from_user.is_bot or reply.from_user.id == message.from_user.id:
+        await message.reply("❌ Ответьте этой командой на сообщение своей пары.")
+        return
+    
+    chat_id = str(message.chat.id)
+    a, b = str(message.from_user.id), str(reply.from_user.id)
+    await storage.executemany(
+        'INSERT OR IGNORE INTO draw_exclusions (chat_id, giver_id, receiver_id) VALUES (?, ?, ?)',
+        [(chat_id, a, b), (chat_id, b, a)]
+    )
+    lang = await get_lang(chat_id)
+    await message.reply(get_text('couple_saved', lang))
+
+@dp.message(Command("team"))
+async def team(message: Message, command: CommandObject):
+    """Задаёт команду (отдел) участника: внутри одной команды подарки не дарят"""
+    if message.chat.type not in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        await message.reply("❌ Эта команда работает только в группах.")
+        return
+    
+    chat_id = str(message.chat.id)
+    target = message.from_user
+    reply = message.reply_to_message
+    if reply and reply.from_user and not reply.from_user.is_bot and reply.from_user.id != message.from_user.id:
+        # Назначать команду другим может только администратор
+        if not await is_admin(message.chat.id, message.from_user.id):
+            await message.reply("❌ Только администраторы могут назначать команду другим участникам.")
+            return
+        target = reply.from_user
+    
+    lang = await get_lang(chat_id)
+    name = sanitize_input(command.args or "", max_length=50)
+    if name:
+        await storage.execute(
+            'INSERT OR REPLACE INTO draw_groups (chat_id, user_id, group_name) VALUES (?, ?, ?)',
+            (chat_id, str(target.id), name)
+        )
+        await message.reply(get_text('team_saved', lang, team=name))
+    else:
+        await storage.execute('DELETE FROM draw_groups WHERE chat_id = ? AND user_id = ?', (chat_id, str(target.id)))
+        await message.reply(get_text('team_cleared', lang))
+
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(2 * 1024 * 1024)))
+
+def parse_roster_csv(text: str) -> tuple:
+    """CSV со строками user_id[,имя] -> ([(user_id, full_name)], число нераспознанных строк)"""
+    users, skipped = [], 0
+    for line_no, row in enumerate(csv.reader(io.StringIO(text)), 1):
+        if not row or not row[0].strip():
+            continue
+        user_id = row[0].strip()
+        if not user_id.isdigit():
+            if line_no > 1:  # первая строка может быть заголовком
+                skipped += 1
+            continue
+        name = sanitize_input(row[1], max_length=100) if len(row) > 1 else ""
+        users.append((user_id, name or f"ID {user_id}"))
+    return users, skipped
+
+async def collect_import_roster(message: Message) -> tuple:
+    """Участники из CSV-файла, упоминаний и пересланного сообщения (в самой команде или в ответе)"""
+    users, skipped = [], 0
+    for source in (message, message.reply_to_message):
+        if source is None:
+            continue
+        if source.document:
+            if (source.document.file_size or 0) > IMPORT_MAX_BYTES:
+                raise ValueError("файл слишком большой")
+            data = await bot.download(source.document)
+            parsed, bad = parse_roster_csv(data.read().decode('utf-8-sig', errors='replace'))
+            users.extend(parsed)
+            skipped += bad
+        for entity in (source.entities or []) + (source.caption_entities or []):
+            if entity.type == 'text_mention' and entity.user and not entity.user.is_bot:
+                users.append((str(entity.user.id), entity.user.full_name))
+            elif entity.type == 'mention':
+                skipped += 1  # @username нельзя превратить в user_id через Bot API
+        origin = source.forward_origin
+        if source is not message and origin is not None and origin.type == 'user' and not origin.sender_user.is_bot:
+            users.append((str(origin.sender_user.id), origin.sender_user.full_name))
+    return users, skipped
+
+@dp.message(Command("import"))
+async def import_players(message: Message):
+    """Массовая регистрация участников администратором"""
+    if message.chat.type not in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        await message.reply("❌ Эта команда работает только в группах.")
+        return
+    
+    if not await is_admin(message.chat.id, message.from_user.id):
+        await message.reply("❌ Только администраторы могут настраивать игру.")
+        return
+    
+    chat_id = str(message.chat.id)
+    game = await get_chat_settings(chat_id)
+    if not game['exists']:
+        await message.reply("❌ Игра не настроена. Используйте /setup для начала.")
+        return
+    lang = game['lang']
+    
+    try:
+        users, skipped = await collect_import_roster(message)
+        if not users and not skipped:
+            await message.reply(get_text('import_usage', lang))
+            return
+        added = await register_users(chat_id, users, game['theme'])
+    except Exception as e:
+        logger.error("Ошибка массовой регистрации в чате %s: %s", chat_id, e)
+        await message.reply("❌ Не удалось импортировать участников.")
+        return
+    
+    await message.reply(get_text(
+        'import_done', lang, added=len(added), existing=len({u for u, _ in users}) - len(added), skipped=skipped
+    ))
 
 @dp.message(F.new_chat_members)
 async def on_join(message: Message):
@@ -511,29 +2797,36 @@ async def on_join(message: Message):
             full_name = f"{user.first_name} {user.last_name}" if user.last_name else user.first_name
             
             # Проверяем, есть ли активная игра
-            with get_db() as db:
-                game = db.execute('SELECT theme FROM games WHERE chat_id = ?', (chat_id,)).fetchone()
-                if not game:
-                    continue  # Нет активной игры
-                
-                theme = game['theme']
+            game = await get_chat_settings(chat_id)
+            if not game['exists']:
+                continue  # Нет активной игры
+            
+            theme = game['theme']
             
             # Автоматически регистрируем нового участника
-            success = await register_user(user_id, chat_id, full_name, theme)
+            nick = await register_user(user_id, chat_id, full_name, theme)
             
-            if success:
-                with get_db() as db:
-                    player = db.execute('SELECT nick FROM players WHERE user_id = ? AND chat_id = ?', (user_id, chat_id)).fetchone()
-                    nick = player['nick'] if player else "Unknown"
-                
-                lang = get_lang(chat_id)
+            if nick:
                 await message.answer(f"👋 {full_name} присоединился к игре с ником {nick}!")
                 logger.info(f"Новый участник {full_name} добавлен в игру {chat_id}")
     except Exception as e:
         logger.error(f"Ошибка обработки новых участников: {e}")
 
-# Добавляем обработчик обычных сообщений для автоматической регистрации активных участников
-@dp.message(F.text)
+@dp.chat_member()
+async def on_chat_member(update: ChatMemberUpdated):
+    """Держит кэш администраторов в актуальном состоянии"""
+    admin_roster.apply(
+        update.chat.id, update.new_chat_member.user.id,
+        isinstance(update.new_chat_member, (ChatMemberOwner, ChatMemberAdministrator))
+    )
+
+@dp.my_chat_member()
+async def on_my_chat_member(update: ChatMemberUpdated):
+    # Права самого бота поменялись — chat_member апдейты могли не приходить, перечитываем список
+    admin_roster.invalidate(update.chat.id)
+
+# Обработчик обычных сообщений для автоматической регистрации активных участников.
+# Регистрируется последним (см. ниже), иначе F.text перехватывает команды и FSM-состояния
 async def auto_register_on_activity(message: Message):
     """Автоматически регистрирует участников при их активности в группе"""
     try:
@@ -547,38 +2840,31 @@ async def auto_register_on_activity(message: Message):
         
         chat_id = str(message.chat.id)
         user_id = str(message.from_user.id)
-        full_name = f"{message.from_user.first_name} {message.from_user.last_name}" if message.from_user.last_name else message.from_user.first_name
         
-        # Проверяем, есть ли активная игра
-        with get_db() as db:
-            game = db.execute('SELECT theme FROM games WHERE chat_id = ?', (chat_id,)).fetchone()
-            if not game:
-                return  # Нет активной игры
-            
-            # Проверяем, уже ли зарегистрирован
-            existing = db.execute('SELECT 1 FROM players WHERE user_id = ? AND chat_id = ?', (user_id, chat_id)).fetchone()
-            if existing:
-                return  # Уже зарегистрирован
-            
-            theme = game['theme']
+        # Быстрый путь без обращения к базе: нет игры или уже зарегистрирован
+        if not membership.has_game(chat_id):
+            return
+        if membership.is_member(chat_id, user_id):
+            return
+        
+        full_name = f"{message.from_user.first_name} {message.from_user.last_name}" if message.from_user.last_name else message.from_user.first_name
+        theme = await get_theme(chat_id)
         
         # Регистрируем пользователя при первой активности
-        success = await register_user(user_id, chat_id, full_name, theme)
+        nick = await register_user(user_id, chat_id, full_name, theme)
         
-        if success:
-            with get_db() as db:
-                player = db.execute('SELECT nick FROM players WHERE user_id = ? AND chat_id = ?', (user_id, chat_id)).fetchone()
-                nick = player['nick'] if player else "Unknown"
-            
-            lang = get_lang(chat_id)
-            logger.info(f"Автоматически зарегистрирован активный участник {full_name} ({user_id}) с ником {nick} в чате {chat_id}")
+        if nick:
+            activity_logger.info(
+                "Автоматически зарегистрирован активный участник %s (%s) с ником %s в чате %s",
+                full_name, user_id, nick, chat_id
+            )
     
     except Exception as e:
-        logger.error(f"Ошибка автоматической регистрации при активности: {e}")
+        logger.error("Ошибка автоматической регистрации при активности: %s", e)
 
 @dp.message(Command("mygift"))
 async def mygift(message: Message, state: FSMContext):
-    lang = get_lang(message.chat.id)
+    lang = await get_lang(message.chat.id)
     await message.reply(get_text('gift_prompt', lang))
     await state.set_state(GiftState.waiting)
 
@@ -588,7 +2874,7 @@ async def set_gift(message: Message, state: FSMContext):
     try:
         user_id = str(message.from_user.id)
         chat_id = str(message.chat.id)
-        lang = get_lang(chat_id)
+        lang = await get_lang(chat_id)
         
         # Валидация ввода
         gift_text = sanitize_input(message.text, max_length=500)
@@ -596,8 +2882,7 @@ async def set_gift(message: Message, state: FSMContext):
             await message.reply("❌ Желание должно содержать минимум 3 символа.")
             return
         
-        with get_db() as db:
-            db.execute('UPDATE players SET gift = ? WHERE user_id = ? AND chat_id = ?', (gift_text, user_id, chat_id))
+        await storage.execute('UPDATE players SET gift = ? WHERE user_id = ? AND chat_id = ?', (gift_text, user_id, chat_id))
         
         await message.reply(get_text('gift_saved', lang))
         await state.clear()
@@ -609,135 +2894,124 @@ async def set_gift(message: Message, state: FSMContext):
 @dp.message(Command("santabingo"))
 async def santabingo(message: Message):
     chat_id = str(message.chat.id)
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
     
-    with get_db() as db:
-        players = db.execute('SELECT nick, user_id FROM players WHERE chat_id = ?', (chat_id,)).fetchall()
-        targets = [p for p in players if p['user_id'] != str(message.from_user.id)]
-        if not targets: return
-        
-        target = random.choice(targets)
-        kb = []
-        shuffled = random.sample(players, len(players))
-        for p in shuffled:
-            kb.append([InlineKeyboardButton(text=p['nick'], callback_data=f"guess_{target['user_id']}_{p['user_id']}")])
-        
-        await message.reply(get_text('santabingo_intro', lang, nick=target['nick']), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    entries, positions = await nick_roster.get(chat_id)
+    # Случайная цель, кроме самого игрока, без копирования списка
+    own = positions.get(str(message.from_user.id))
+    count = len(entries) - (own is not None)
+    if count <= 0: return
+    index = random.randrange(count)
+    if own is not None and index >= own:
+        index += 1
+    target_id, target_nick = entries[index]
+    
+    await message.reply(
+        get_text('santabingo_intro', lang, nick=target_nick),
+        reply_markup=bingo_keyboard(entries, target_id, random.randrange(len(entries) // BINGO_PAGE_SIZE + 1))
+    )
 
-@dp.callback_query(F.data == "join_game")
+@dp.callback_query(CallbackKind(CB_BINGO))
+async def bingo_page(callback, cb_args: tuple):
+    target_id, page = cb_args
+    entries, _ = await nick_roster.get(str(callback.message.chat.id))
+    try:
+        await callback.message.edit_reply_markup(reply_markup=bingo_keyboard(entries, target_id, page))
+    except TelegramBadRequest:
+        pass  # та же страница — "message is not modified"
+    await callback.answer()
+
+@dp.callback_query(CallbackKind(CB_JOIN))
 async def join_game(callback):
     """Обрабатывает запрос на участие в игре"""
     try:
         chat_id = str(callback.message.chat.id)
         user_id = str(callback.from_user.id)
         full_name = f"{callback.from_user.first_name} {callback.from_user.last_name}" if callback.from_user.last_name else callback.from_user.first_name
-        lang = get_lang(chat_id)
+        lang = await get_lang(chat_id)
         
         # Получаем тему игры
-        with get_db() as db:
-            game = db.execute('SELECT theme FROM games WHERE chat_id = ?', (chat_id,)).fetchone()
-            if not game:
-                await callback.answer("❌ Игра не настроена.", show_alert=True)
-                return
-            
-            theme = game['theme']
+        game = await get_chat_settings(chat_id)
+        if not game['exists']:
+            await callback.answer("❌ Игра не настроена.", show_alert=True)
+            return
+        
+        theme = game['theme']
         
         # Регистрируем пользователя
-        success = await register_user(user_id, chat_id, full_name, theme)
+        nick = await register_user(user_id, chat_id, full_name, theme)
         
-        if success:
-            # Получаем ник пользователя
-            with get_db() as db:
-                player = db.execute('SELECT nick FROM players WHERE user_id = ? AND chat_id = ?', (user_id, chat_id)).fetchone()
-                nick = player['nick'] if player else "Unknown"
-            
-            await callback.answer(get_text('joined_game', lang).format(nick=nick), show_alert=True)
+        if nick:
+            await callback.answer(get_text('joined_game', lang, nick=nick), show_alert=True)
+            # Число участников в сообщении обновится одной общей правкой
+            join_updater.request(chat_id, callback.message.message_id, lang)
         else:
             await callback.answer(get_text('already_joined', lang), show_alert=True)
         
-        # Обновляем количество участников в сообщении
-        with get_db() as db:
-            result = db.execute('SELECT COUNT(*) as cnt FROM players WHERE chat_id = ?', (chat_id,)).fetchone()
-            count = result['cnt'] if result else 0
-        
-        new_message = get_text('auto_register_call', lang).format(count=count)
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎄 Участвовать в игре", callback_data="join_game")]
-        ])
-        
-        await callback.message.edit_text(new_message, reply_markup=kb)
-        
     except Exception as e:
         logger.error(f"Ошибка при присоединении к игре: {e}")
         await callback.answer("❌ Произошла ошибка при регистрации.", show_alert=True)
 
-@dp.callback_query(F.data.startswith("guess_"))
-async def process_guess(callback):
-    _, target_id, selected_id = callback.data.split("_")
+@dp.callback_query(CallbackKind(CB_GUESS))
+async def process_guess(callback, cb_args: tuple):
+    target_id, selected_id = map(str, cb_args)
     user_id = str(callback.from_user.id)
     chat_id = str(callback.message.chat.id)
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
     
     correct = target_id == selected_id
-    with get_db() as db:
-        if correct:
-            db.execute('UPDATE players SET score = score + 1 WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
-            await callback.message.edit_text(get_text('guess_correct', lang))
-        else:
-            name = db.execute('SELECT full_name FROM players WHERE user_id = ? AND chat_id = ?', (target_id, chat_id)).fetchone()
-            await callback.message.edit_text(get_text('guess_wrong', lang, name=name['full_name'] if name else "Unknown"))
+    if correct:
+        score_buffer.add(chat_id, user_id)
+        leaderboard_cache.record(chat_id, user_id)
+        await callback.message.edit_text(get_text('guess_correct', lang))
+    else:
+        name = await storage.fetchone('SELECT full_name FROM players WHERE user_id = ? AND chat_id = ?', (target_id, chat_id))
+        await callback.message.edit_text(get_text('guess_wrong', lang, name=name['full_name'] if name else "Unknown"))
     await callback.answer()
 
 @dp.message(Command("leaderboard"))
 async def leaderboard(message: Message):
     chat_id = str(message.chat.id)
-    lang = get_lang(chat_id)
-    
-    with get_db() as db:
-        players = db.execute('''
-            SELECT nick, score FROM players
-            WHERE chat_id = ?
-            ORDER BY score DESC
-            LIMIT 10
-        ''', (chat_id,)).fetchall()
-        
-        if not players:
-            await message.reply("📊 Таблица лидеров пуста")
-            return
-        
-        player_list = ""
-        for i, p in enumerate(players, 1):
-            player_list += f"{i}. {p['nick']} — {p['score']} очков\n"
-        
-        text = get_text('leaderboard', lang, list=player_list)
+    lang = await get_lang(chat_id)
+    
+    text = await leaderboard_cache.render(chat_id, lang)
+    if text is None:
+        await message.reply("📊 Таблица лидеров пуста")
+        return
     
     await message.reply(text)
 
 @dp.message(Command("premium"))
 async def premium(message: Message, state: FSMContext):
     chat_id = str(message.chat.id)
-    lang = get_lang(chat_id)
-    theme = get_theme(chat_id)
+    lang = await get_lang(chat_id)
+    theme = await get_theme(chat_id)
     
-    if theme not in PREMIUM_NICKS[lang]:
+    # Для языков из файлов ники берутся из запасного: их индексы зашиты в callback_data
+    nicks_by_theme = PREMIUM_NICKS.get(lang, PREMIUM_NICKS[FALLBACK_LANG])
+    if theme not in nicks_by_theme:
         await message.reply("❌ Тема не установлена.")
         return
     
-    nicks = PREMIUM_NICKS[lang][theme]
-    kb = [[InlineKeyboardButton(text=f"✨ {n}", callback_data=f"buy_{n}")] for n in nicks]
-    await message.reply(get_text('premium_intro', lang), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    nicks = nicks_by_theme[theme]
+    kb = texts.keyboard(('premium', lang, theme), lambda: InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"✨ {n}", callback_data=pack_callback(CB_BUY, PREMIUM_NICK_IDS[n]))] for n in nicks
+    ]))
+    await message.reply(get_text('premium_intro', lang), reply_markup=kb)
     await state.set_state(PremiumState.choosing)
 
-@dp.callback_query(F.data.startswith("buy_"))
-async def buy_nick(callback, state: FSMContext):
-    nick = callback.data.replace("buy_", "")
+@dp.callback_query(CallbackKind(CB_BUY))
+async def buy_nick(callback, state: FSMContext, cb_args: tuple):
+    if not 0 <= cb_args[0] < len(PREMIUM_NICK_TABLE):
+        await callback.answer()
+        return
+    nick = PREMIUM_NICK_TABLE[cb_args[0]]
     chat_id = str(callback.message.chat.id)
-    lang = get_lang(chat_id)
+    lang = await get_lang(chat_id)
     
-    with get_db() as db:
-        if db.execute('SELECT 1 FROM players WHERE premium_nick = ? AND chat_id = ?', (nick, chat_id)).fetchone():
-            await callback.message.edit_text(get_text('premium_sold', lang))
-            return
+    if await storage.fetchone('SELECT 1 FROM players WHERE premium_nick = ? AND chat_id = ?', (nick, chat_id)):
+        await callback.message.edit_text(get_text('premium_sold', lang))
+        return
     
     prices = [LabeledPrice(label="Премиум-ник", amount=50)]
     await bot.send_invoice(
@@ -756,30 +3030,36 @@ async def buy_nick(callback, state: FSMContext):
 async def checkout(query: PreCheckoutQuery):
     await bot.answer_pre_checkout_query(query.id, ok=True)
 
+def parse_premium_payload(payload: str) -> Optional[tuple]:
+    """payload счёта за премиум-ник "premium_<ник>_<chat_id>" -> (ник, chat_id)"""
+    parts = payload.split("_")
+    if len(parts) < 3 or parts[0] != "premium":
+        return None
+    return "_".join(parts[1:-1]), parts[-1]
+
 @dp.message(F.successful_payment)
 async def success_pay(message: Message):
-    data = message.successful_payment.invoice_payload
-    parts = data.split("_")
-    if len(parts) < 3:
+    parsed = parse_premium_payload(message.successful_payment.invoice_payload)
+    if parsed is None:
         return
-    nick = "_".join(parts[1:-1])
-    chat_id = parts[-1]
+    nick, chat_id = parsed
     user_id = str(message.from_user.id)
     
-    with get_db() as db:
-        player = db.execute('SELECT chat_id FROM players WHERE user_id = ?', (user_id,)).fetchone()
-        if not player or player['chat_id'] != chat_id:
-            await message.answer("❌ Вы не участвуете в этой игре.")
-            return
-        
-        if db.execute('SELECT 1 FROM players WHERE premium_nick = ? AND chat_id = ?', (nick, chat_id)).fetchone():
-            await message.answer("🚫 Этот ник уже куплен.")
-            return
-        
-        db.execute('UPDATE players SET nick = ?, premium_nick = ? WHERE user_id = ? AND chat_id = ?', 
-                  (nick, nick, user_id, chat_id))
+    player = await storage.fetchone('SELECT 1 FROM players WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+    if not player:
+        await message.answer("❌ Вы не участвуете в этой игре.")
+        return
+    
+    if await storage.fetchone('SELECT 1 FROM players WHERE premium_nick = ? AND chat_id = ?', (nick, chat_id)):
+        await message.answer("🚫 Этот ник уже куплен.")
+        return
     
-    lang = get_lang(chat_id)
+    await storage.execute('UPDATE players SET nick = ?, premium_nick = ? WHERE user_id = ? AND chat_id = ?', 
+                          (nick, nick, user_id, chat_id))
+    nick_roster.invalidate(chat_id)
+    leaderboard_cache.rename(chat_id, user_id, nick)
+    
+    lang = await get_lang(chat_id)
     await message.answer(get_text('nick_unlocked', lang, nick=nick))
 
 @dp.message(Command("info"))
@@ -787,41 +3067,46 @@ async def game_info(message: Message):
     """Показывает информацию о текущей игре"""
     chat_id = str(message.chat.id)
     
-    with get_db() as db:
-        game = db.execute('SELECT * FROM games WHERE chat_id = ?', (chat_id,)).fetchone()
-        if not game:
-            await message.reply("❌ Игра не настроена. Используйте /setup для начала.")
-            return
-        
-        players_count = db.execute('SELECT COUNT(*) as cnt FROM players WHERE chat_id = ?', (chat_id,)).fetchone()['cnt']
-        
-        info_text = f"🎮 **Информация об игре**\n\n"
-        info_text += f"🎨 Тема: {game['theme']}\n"
-        info_text += f"👥 Участников: {players_count}\n"
-        
-        if game['draw_time']:
-            draw_dt = datetime.fromtimestamp(game['draw_time'])
-            info_text += f"🎲 Жеребьевка: {draw_dt.strftime('%d.%m.%Y %H:%M')}\n"
-        
-        if game['end_time']:
-            end_dt = datetime.fromtimestamp(game['end_time'])
-            info_text += f"🎊 Раскрытие: {end_dt.strftime('%d.%m.%Y %H:%M')}\n"
-        
-        info_text += f"🌍 Язык: {game['lang']}"
+    game = await storage.fetchone('SELECT * FROM games WHERE chat_id = ?', (chat_id,))
+    if not game:
+        await message.reply("❌ Игра не настроена. Используйте /setup для начала.")
+        return
+    
+    players_count = (await storage.fetchone('SELECT COUNT(*) as cnt FROM players WHERE chat_id = ?', (chat_id,)))['cnt']
+    
+    info_text = f"🎮 **Информация об игре**\n\n"
+    info_text += f"🎨 Тема: {game['theme']}\n"
+    info_text += f"👥 Участников: {players_count}\n"
+    
+    if game['draw_time']:
+        draw_dt = datetime.fromtimestamp(game['draw_time'])
+        info_text += f"🎲 Жеребьевка: {draw_dt.strftime('%d.%m.%Y %H:%M')}\n"
+    
+    if game['end_time']:
+        end_dt = datetime.fromtimestamp(game['end_time'])
+        info_text += f"🎊 Раскрытие: {end_dt.strftime('%d.%m.%Y %H:%M')}\n"
+    
+    info_text += f"🌍 Язык: {game['lang']}"
     
     await message.reply(info_text, parse_mode=ParseMode.MARKDOWN)
 
 @dp.message(Command("lang"))
-async def change_lang(message: Message):
+async def change_lang(message: Message, command: CommandObject):
     chat_id = str(message.chat.id)
-    with get_db() as db:
-        db.execute('UPDATE games SET lang = ? WHERE chat_id = ?', ('en' if get_lang(chat_id) == 'ru' else 'ru', chat_id))
-    lang = get_lang(chat_id)
+    # /lang без аргумента переключает ru/en, /lang <код> выбирает язык из LOCALES_DIR
+    requested = (command.args or '').strip().lower()
+    if requested and texts.available(requested):
+        new_lang = requested
+    else:
+        new_lang = 'en' if await get_lang(chat_id) == 'ru' else 'ru'
+    if await storage.execute('UPDATE games SET lang = ? WHERE chat_id = ?', (new_lang, chat_id)):
+        settings_cache.update(chat_id, lang=new_lang)
+    lang = await get_lang(chat_id)
     await message.reply(get_text('lang_changed', lang))
 
 @dp.message(Command("donate"))
 async def donate(message: Message):
-    lang = get_lang(message.chat.id)
+    lang = await get_lang(message.chat.id)
     prices = [LabeledPrice(label=f"{amt} звёзд", amount=amt) for amt in [1, 10, 25, 50, 100, 500, 1000, 5000]]
     await bot.send_invoice(
         chat_id=message.chat.id,
@@ -834,12 +3119,36 @@ async def donate(message: Message):
         need_name=False
     )
 
+dp.message.register(auto_register_on_activity, F.text)
+
 # === ГЛОБАЛЬНЫЙ ОБРАБОТЧИК ОШИБОК ===
+ERROR_TRACE_INTERVAL = 60.0
+_error_seen: Dict[tuple, float] = {}
+
+def _error_key(exception: BaseException) -> tuple:
+    """Тип исключения и строка, где оно возникло, — ключ для дедупликации traceback"""
+    tb = exception.__traceback__
+    while tb is not None and tb.tb_next is not None:
+        tb = tb.tb_next
+    if tb is None:
+        return (type(exception).__name__,)
+    return (type(exception).__name__, tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+
+
 @dp.error()
 async def error_handler(event: ErrorEvent):
     """Глобальный обработчик ошибок для aiogram 3.x"""
-    logger.error(f"Ошибка обработки обновления {event.update}: {event.exception}")
-    logger.error(traceback.format_exc())
+    # Полный traceback — один раз в минуту на место падения, дальше одной строкой
+    exception = event.exception
+    key = _error_key(exception)
+    now = time.monotonic()
+    verbose = now - _error_seen.get(key, -ERROR_TRACE_INTERVAL) >= ERROR_TRACE_INTERVAL
+    if verbose:
+        _error_seen[key] = now
+    logger.error(
+        "Ошибка обработки апдейта %s (%s): %r", event.update.update_id, event.update.event_type, exception,
+        exc_info=exception if verbose else None
+    )
     
     # Попытка отправить уведомление пользователю
     try:
@@ -975,13 +3284,272 @@ Instance ID: {INSTANCE_ID}
         logger.error(error_msg)
         raise RuntimeError("Критический сбой запуска из-за конфликтов")
 
+# === WEBHOOK ===
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+# По умолчанию выводится из токена: секрет не меняется между рестартами и не требует отдельной настройки
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook{BOT_TOKEN}".encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничивает число одновременно обрабатываемых апдейтов"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __call__(self, handler, event, data):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        async with self._semaphore:
+            return await handler(event, data)
+
+async def healthcheck(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+def build_webhook_app() -> web.Application:
+    """aiohttp-приложение: приём апдейтов с проверкой секрета и /healthz"""
+    app = web.Application()
+    app.router.add_get("/healthz", healthcheck)
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, handle_in_background=True, secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    """
+    Режим webhook: Telegram сам присылает апдейты на aiohttp-сервер.
+    Ответ 200 уходит сразу, апдейт обрабатывается в фоне.
+    Экземпляр должен быть один на токен: индекс участников, кэши, задачи
+    планировщика и очередь рассылки живут в памяти процесса. Для
+    масштабирования есть шарды (--shards вместе с --webhook).
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL не установлен")
+    
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(WEBHOOK_MAX_CONCURRENCY))
+    app = build_webhook_app()
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    try:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"🌐 Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# === ШАРДИРОВАННЫЙ РЕЖИМ ===
+# Фронт-процесс получает апдейты (polling или webhook) и раскладывает их по
+# воркерам по хэшу chat_id. Все апдейты чата попадают в один воркер, и там
+# обрабатываются строго по очереди, поэтому порядок внутри чата сохраняется,
+# а кэши и индексы воркера содержат только его чаты.
+SHARD_WORKER_CONCURRENCY = int(os.getenv("SHARD_WORKER_CONCURRENCY", "64"))
+
+def update_chat_id(update: Dict[str, Any]) -> Optional[int]:
+    """Чат, к которому относится сырой апдейт Telegram"""
+    payment = (update.get('message') or {}).get('successful_payment')
+    if payment:
+        # Покупка премиум-ника меняет ник в группе из payload — её шард и должен обработать оплату
+        parsed = parse_premium_payload(payment.get('invoice_payload', ''))
+        if parsed and parsed[1].lstrip('-').isdigit():
+            return int(parsed[1])
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'my_chat_member', 'chat_member', 'chat_join_request'):
+        event = update.get(key)
+        if event and 'chat' in event:
+            return event['chat']['id']
+    callback = update.get('callback_query')
+    if callback:
+        message = callback.get('message')
+        if message and 'chat' in message:
+            return message['chat']['id']
+        return callback['from']['id']
+    for key in ('pre_checkout_query', 'shipping_query', 'inline_query', 'chosen_inline_result', 'poll_answer'):
+        event = update.get(key)
+        if event:
+            user = event.get('from') or event.get('user')
+            if user:
+                return user['id']
+    return None
+
+class ShardRouter:
+    def __init__(self, queues):
+        self.queues = queues
+        self.routed = [0] * len(queues)
+
+    def route(self, update: Dict[str, Any]):
+        chat_id = update_chat_id(update)
+        shard = shard_of(chat_id, len(self.queues)) if chat_id is not None else 0
+        self.routed[shard] += 1
+        self.queues[shard].put(update)
+
+async def run_shard_worker(shard_id: int, shard_count: int, queue):
+    global SHARD_ID, SHARD_COUNT
+    SHARD_ID, SHARD_COUNT = shard_id, shard_count
+    # Ротация одного файла из нескольких процессов небезопасна — у каждого шарда свой лог
+    base, ext = os.path.splitext(LOG_FILE)
+    setup_logging(f"{base}.shard{shard_id}{ext}")
+    
+    await init_db(migrate=False)
+    await warm_membership_index()
+    await broadcaster.start()
+    score_buffer.start()
+    scheduler.start()
+    await rehydrate_jobs()
+    schedule_fsm_cleanup()
+    # Каждый воркер отдаёт свои метрики на соседнем порту: METRICS_PORT + 1 + номер шарда
+    await start_metrics_server(METRICS_PORT and METRICS_PORT + 1 + shard_id)
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(SHARD_WORKER_CONCURRENCY))
+    logger.info(f"Шард {shard_id}/{shard_count} запущен")
+    
+    loop = asyncio.get_running_loop()
+    chat_locks: Dict[Any, list] = {}  # chat_id -> [lock, число ожидающих апдейтов]
+    tasks: set = set()
+    
+    async def process(update: Dict[str, Any], key):
+        entry = chat_locks[key]
+        try:
+            async with entry[0]:
+                await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error("Шард %s: ошибка обработки апдейта: %s", shard_id, e)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                chat_locks.pop(key, None)
+    
+    try:
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            key = update_chat_id(update)
+            entry = chat_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            # asyncio.Lock будит ожидающих в порядке очереди — порядок апдейтов чата сохраняется
+            task = asyncio.create_task(process(update, key))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        scheduler.shutdown()
+        await broadcaster.stop()
+        await score_buffer.stop()
+        await join_updater.stop()
+        await storage.close()
+        await bot.session.close()
+
+def _shard_worker_main(shard_id: int, shard_count: int, queue):
+    try:
+        asyncio.run(run_shard_worker(shard_id, shard_count, queue))
+    except KeyboardInterrupt:
+        pass
+
+async def _shard_polling(router: ShardRouter, polling_timeout: int = 30):
+    if not await check_bot_conflicts():
+        raise RuntimeError("Ошибка проверки конфликтов бота")
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=polling_timeout, allowed_updates=allowed_updates,
+                request_timeout=polling_timeout + 10
+            )
+        except Exception as e:
+            logger.error("Ошибка получения апдейтов: %s", e)
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            router.route(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+
+async def _shard_webhook(router: ShardRouter):
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL не установлен")
+    
+    async def receive(request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        router.route(await request.json())
+        return web.Response()
+    
+    app = web.Application()
+    app.router.add_get("/healthz", healthcheck)
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    try:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"🌐 Webhook (шардированный) слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def run_sharded(shards: int, webhook: bool = False):
+    """Фронт-процесс: миграции, запуск воркеров и маршрутизация апдейтов"""
+    await init_db()
+    await storage.close()
+    
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(shards)]
+    workers = [
+        ctx.Process(target=_shard_worker_main, args=(i, shards, queues[i]), name=f"santa-shard-{i}", daemon=True)
+        for i in range(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    router = ShardRouter(queues)
+    logger.info(f"✅ Secret Santa Bot запущен: {shards} шардов (Instance: {INSTANCE_ID})")
+    
+    try:
+        await set_bot_commands()
+        await start_metrics_server(METRICS_PORT)
+        if webhook:
+            await _shard_webhook(router)
+        else:
+            await _shard_polling(router)
+    finally:
+        logger.info(f"Распределение апдейтов по шардам: {router.routed}")
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.join, 10)
+        await bot.session.close()
+
 # === ЗАПУСК ===
-async def main():
+async def main(webhook: bool = False):
     try:
         # Инициализация
-        init_db()
+        await init_db()
+        await warm_membership_index()
+        await broadcaster.start()
+        score_buffer.start()
         await set_bot_commands()
         scheduler.start()
+        await rehydrate_jobs()
+        await fsm_storage.purge_expired()
+        schedule_fsm_cleanup()
+        await start_metrics_server(METRICS_PORT)
+        
+        if webhook:
+            logger.info(f"✅ Secret Santa Bot запущен в режиме webhook (Instance: {INSTANCE_ID})")
+            await run_webhook()
+            return
         
         # Проверка конфликтов
         if not await check_bot_conflicts():
@@ -1001,13 +3569,33 @@ async def main():
     finally:
         try:
             scheduler.shutdown()
+            await broadcaster.stop()
+            await score_buffer.stop()
+            await join_updater.stop()
+            logger.info(f"Правки призыва к участию: {join_updater.stats}")
+            logger.info(f"Ограничение частоты: {throttling.stats}")
+            logger.info(f"Статистика кэша лидеров: {leaderboard_cache.stats()}")
+            logger.info(f"Запросов к базе: {storage.transactions} транзакций"
+                        + (f", {storage.statements} операторов" if storage.count_statements else ""))
+            logger.info(f"Статистика кэша настроек: {settings_cache.stats()}")
+            logger.info(f"Статистика буфера очков: {score_buffer.stats}")
+            logger.info(f"Статистика кэша FSM: {fsm_storage.stats()}")
+            await storage.close()
             await bot.session.close()
         except:
             pass
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Secret Santa Mystery Bot")
+    parser.add_argument("--webhook", action="store_true", help="принимать апдейты через webhook вместо polling")
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARDS", "1")),
+                        help="число процессов-воркеров, между которыми делятся чаты")
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        if args.shards > 1:
+            asyncio.run(run_sharded(args.shards, webhook=args.webhook))
+        else:
+            asyncio.run(main(webhook=args.webhook))
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
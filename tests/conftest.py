@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main читает окружение при импорте: токен-заглушка, база и лог во временном каталоге
+_tmp = tempfile.mkdtemp(prefix="santa-tests-")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DB_NAME", os.path.join(_tmp, "test.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(_tmp, "bot.log"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def run_db(tmp_path, monkeypatch):
+    """run_db(scenario) — выполняет корутину scenario() на чистой базе со всеми миграциями"""
+    import main
+    monkeypatch.setattr(main.storage, "path", str(tmp_path / "santa.db"))
+
+    def run(scenario):
+        async def wrapper():
+            await main.init_db()
+            try:
+                return await scenario()
+            finally:
+                await main.storage.close()
+        return asyncio.run(wrapper())
+    return run
@@ -0,0 +1,33 @@
+import asyncio
+
+import main
+
+
+def test_rows_replaced_by_a_new_draw_are_not_sent(run_db, monkeypatch):
+    sent = []
+
+    async def fake_request(bot, method, timeout=None):
+        if type(method).__name__ == "SendMessage" and method.chat_id != "-1":
+            sent.append((method.chat_id, method.text))
+        return True
+    monkeypatch.setattr(main.bot.session, "make_request", fake_request)
+    monkeypatch.setattr(main.broadcaster, "_queue", None)
+
+    async def scenario():
+        await main.storage.execute("INSERT INTO games (chat_id) VALUES ('-1')")
+        await main.register_users("-1", [(str(i), f"u{i}") for i in range(1, 4)])
+        # Первая жеребьёвка ещё в очереди рассылки, когда админ проводит вторую
+        await main.do_draw("-1")
+        await main.do_draw("-1")
+        current = await main.storage.fetchall("SELECT recipient, text FROM outbox WHERE status = 'pending'")
+        assert main.broadcaster.queue.qsize() == 6
+        # start() ставит в очередь те же строки ещё раз — захват не даст отправить их дважды
+        await main.broadcaster.start()
+        await asyncio.wait_for(main.broadcaster.queue.join(), 5)
+        await main.broadcaster.stop()
+        statuses = await main.storage.fetchall("SELECT DISTINCT status FROM outbox")
+        return sorted((row['recipient'], row['text']) for row in current), [row['status'] for row in statuses]
+    current, statuses = run_db(scenario)
+    assert len(current) == 3
+    assert sorted(sent) == current
+    assert statuses == ['sent']
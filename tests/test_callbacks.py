@@ -0,0 +1,69 @@
+import pytest
+
+import main
+
+# Самые длинные реальные значения: id пользователей до 2^52, id супергрупп вида -100xxxxxxxxxx
+BIG_USER = 2 ** 52 - 1
+BIG_CHAT = -1009999999999
+
+
+@pytest.mark.parametrize("kind, values", [
+    (main.CB_JOIN, ()),
+    (main.CB_HELP, ()),
+    (main.CB_THEME, (2,)),
+    (main.CB_GUESS, (BIG_USER, BIG_USER - 1)),
+    (main.CB_GUESS, (0, 1)),
+    (main.CB_BINGO, (BIG_CHAT, -1)),
+    (main.CB_BINGO, (-7, -300)),
+    (main.CB_BUY, (len(main.PREMIUM_NICK_TABLE) - 1,)),
+])
+def test_round_trip(kind, values):
+    data = main.pack_callback(kind, *values)
+    assert main.unpack_callback(data) == (kind, *values)
+    assert len(data.encode()) <= 64
+
+
+def test_every_real_button_fits_the_limit():
+    widest = [
+        main.pack_callback(main.CB_GUESS, BIG_USER, -BIG_USER),
+        main.pack_callback(main.CB_BINGO, BIG_CHAT, BIG_USER),
+    ] + [main.pack_callback(main.CB_BUY, i) for i in range(len(main.PREMIUM_NICK_TABLE))]
+    assert max(len(data.encode()) for data in widest) <= 64
+
+
+@pytest.mark.parametrize("data", [
+    main.pack_callback(main.CB_GUESS, 1),         # не хватает числа
+    main.pack_callback(main.CB_JOIN, 5),          # лишнее число
+    main.pack_callback(main.CB_THEME, 1, 2),
+    main.pack_callback(main.CB_GUESS, 1, 300)[:-2],  # оборванный varint
+    "!!!",
+    "@@@@",
+    "",
+    "something_else",
+    "guess_1",
+    "guess_a_b",
+    "theme_winter",
+    "buy_Нет такого ника",
+])
+def test_foreign_or_broken_data(data):
+    assert main.unpack_callback(data) is None
+
+
+@pytest.mark.parametrize("data, expected", [
+    ("join_game", (main.CB_JOIN,)),
+    ("help", (main.CB_HELP,)),
+    ("theme_christmas", (main.CB_THEME, 0)),
+    ("theme_halloween", (main.CB_THEME, 1)),
+    ("theme_office", (main.CB_THEME, 2)),
+    ("guess_123456789_987654321", (main.CB_GUESS, 123456789, 987654321)),
+    ("bingo_-100123_42", (main.CB_BINGO, -100123, 42)),
+])
+def test_legacy_payloads(data, expected):
+    assert main.unpack_callback(data) == expected
+
+
+def test_legacy_buy_with_unicode_nicks():
+    for nick in main.PREMIUM_NICK_TABLE:
+        kind, index = main.unpack_callback(f"buy_{nick}")
+        assert kind == main.CB_BUY and main.PREMIUM_NICK_TABLE[index] == nick
+    assert any(not nick.isascii() for nick in main.PREMIUM_NICK_TABLE)
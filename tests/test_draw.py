@@ -0,0 +1,92 @@
+import random
+import time
+
+import pytest
+
+import main
+
+
+def assert_valid(users, pairs, exclusions=None, groups=None):
+    exclusions = exclusions or {}
+    groups = groups or {}
+    assert sorted(pairs) == sorted(users)
+    assert sorted(pairs.values()) == sorted(users)
+    for giver, receiver in pairs.items():
+        assert giver != receiver
+        assert receiver not in exclusions.get(giver, ())
+        assert groups.get(giver) is None or groups.get(giver) != groups.get(receiver)
+
+
+def test_couples_and_departments():
+    users = [str(i) for i in range(500)]
+    exclusions = {users[i]: {users[i ^ 1]} for i in range(500)}
+    groups = {u: f"dep{i % 3}" for i, u in enumerate(users)}
+    assert_valid(users, main.solve_draw(users, exclusions, groups), exclusions, groups)
+
+
+def test_two_players_swap():
+    assert main.solve_draw(["a", "b"]) == {"a": "b", "b": "a"}
+
+
+def test_oversized_team_is_infeasible():
+    users = [str(i) for i in range(5)]
+    with pytest.raises(main.DrawInfeasible, match="команде"):
+        main.solve_draw(users, groups={u: "x" for u in users[:3]})
+
+
+def test_giver_without_candidates():
+    users = ["a", "b", "c"]
+    with pytest.raises(main.DrawInfeasible, match="a"):
+        main.solve_draw(users, {"a": {"b", "c"}})
+
+
+def test_receiver_without_givers():
+    users = ["a", "b", "c", "d"]
+    exclusions = {u: {"d"} for u in users}
+    with pytest.raises(main.DrawInfeasible, match="никто не может дарить"):
+        main.solve_draw(users, exclusions)
+
+
+def test_hall_violation_is_reported():
+    # Каждому хватает кандидатов, но a, b и c могут дарить только d и e
+    users = ["a", "b", "c", "d", "e"]
+    exclusions = {u: {"a", "b", "c"} for u in "abc"}
+    with pytest.raises(main.DrawInfeasible):
+        main.solve_draw(users, exclusions)
+
+
+@pytest.mark.parametrize("n, build", [
+    (5000, lambda users: ({}, {u: "team" for u in users[:len(users) // 2]})),
+    (2000, lambda users: ({u: set(random.Random(i).sample(users, 1800)) - {u} for i, u in enumerate(users)}, {})),
+])
+def test_tight_inputs_stay_fast(n, build):
+    users = [str(i) for i in range(n)]
+    exclusions, groups = build(users)
+    started = time.perf_counter()
+    pairs = main.solve_draw(users, exclusions, groups)
+    assert time.perf_counter() - started < 2
+    assert_valid(users, pairs, exclusions, groups)
+
+
+def test_oversized_team_does_not_block_the_draw(run_db, monkeypatch):
+    sent = []
+
+    async def fake_request(bot, method, timeout=None):
+        sent.append(getattr(method, "text", None))
+        return True
+    monkeypatch.setattr(main.bot.session, "make_request", fake_request)
+    monkeypatch.setattr(main.broadcaster, "submit", lambda rows: None)
+
+    async def scenario():
+        await main.storage.execute("INSERT INTO games (chat_id) VALUES ('-1')")
+        await main.register_users("-1", [(str(i), f"u{i}") for i in range(5)])
+        # Трое из пяти записались в одну команду — строго так пары не подобрать
+        await main.storage.executemany(
+            "INSERT INTO draw_groups (chat_id, user_id, group_name) VALUES ('-1', ?, 'x')", [("0",), ("1",), ("2",)]
+        )
+        await main.do_draw("-1")
+        rows = await main.storage.fetchall("SELECT user_id, target_id FROM players WHERE chat_id = '-1'")
+        return {row['user_id']: row['target_id'] for row in rows}
+    pairs = run_db(scenario)
+    assert_valid([str(i) for i in range(5)], pairs)
+    assert sent == [main.get_text('draw_done', 'ru')]
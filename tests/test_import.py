@@ -0,0 +1,114 @@
+import asyncio
+import datetime
+import io
+
+from aiogram.types import Chat, Document, Message, MessageEntity, MessageOriginUser, User
+
+import main
+
+
+def test_csv_header_and_bad_rows():
+    text = "user_id,name\n101,Анна\n\nabc,Борис\n102\n 103 , Вера \n"
+    users, skipped = main.parse_roster_csv(text)
+    assert users == [("101", "Анна"), ("102", "ID 102"), ("103", "Вера")]
+    # Заголовок не считается ошибкой, нечисловой id в середине — считается
+    assert skipped == 1
+
+
+def test_csv_without_header_counts_first_row():
+    assert main.parse_roster_csv("x,y\n5,z") == ([("5", "z")], 0)
+    assert main.parse_roster_csv("5,z\nx,y") == ([("5", "z")], 1)
+
+
+def group_message(**kwargs):
+    return Message(
+        message_id=1, date=datetime.datetime.now(), chat=Chat(id=-1, type="supergroup"),
+        from_user=User(id=1, is_bot=False, first_name="admin"), **kwargs
+    )
+
+
+def test_collect_roster_from_file_mentions_and_forward(monkeypatch):
+    async def fake_download(document):
+        assert document.file_id == "csv"
+        return io.BytesIO("﻿user_id,name\n201,Из файла\n".encode())
+    monkeypatch.setattr(main.bot, "download", fake_download)
+
+    forwarded = group_message(
+        text="привет", forward_origin=MessageOriginUser(
+            date=datetime.datetime.now(), sender_user=User(id=301, is_bot=False, first_name="Пересланный")
+        )
+    )
+    command = group_message(
+        caption="/import @someone Дина",
+        document=Document(file_id="csv", file_unique_id="csv", file_size=100),
+        caption_entities=[
+            MessageEntity(type="bot_command", offset=0, length=7),
+            MessageEntity(type="mention", offset=8, length=8),
+            MessageEntity(type="text_mention", offset=17, length=4, user=User(id=401, is_bot=False, first_name="Дина")),
+        ],
+        reply_to_message=forwarded,
+    )
+    users, skipped = asyncio.run(main.collect_import_roster(command))
+    assert users == [("201", "Из файла"), ("401", "Дина"), ("301", "Пересланный")]
+    assert skipped == 1  # @username не превратить в user_id
+
+
+def test_collect_roster_rejects_large_files():
+    command = group_message(
+        caption="/import", document=Document(file_id="f", file_unique_id="f", file_size=main.IMPORT_MAX_BYTES + 1)
+    )
+    try:
+        asyncio.run(main.collect_import_roster(command))
+    except ValueError:
+        return
+    raise AssertionError("большой файл должен отклоняться")
+
+
+def test_bulk_insert_retries_after_nick_conflict(run_db, monkeypatch):
+    taken = "Санта01"
+    allocate = main.nick_allocator.allocate
+    calls = {'n': 0}
+
+    def conflicting_allocate(db, chat_id, theme):
+        # Третий ник первой попытки совпадает с ником, занятым в обход аллокатора
+        calls['n'] += 1
+        return taken if calls['n'] == 3 else allocate(db, chat_id, theme)
+    monkeypatch.setattr(main.nick_allocator, "allocate", conflicting_allocate)
+
+    async def scenario():
+        await main.storage.execute(
+            "INSERT INTO players (user_id, chat_id, full_name, nick) VALUES ('999', '-1', 'Старый', ?)", (taken,)
+        )
+        main.nick_allocator.forget("-1")
+        added = await main.register_users("-1", [(str(i), f"u{i}") for i in range(1, 6)])
+        rows = await main.storage.fetchall("SELECT user_id, nick FROM players WHERE chat_id = '-1'")
+        return added, rows
+    added, rows = run_db(scenario)
+    assert [user_id for user_id, _, _ in added] == ["1", "2", "3", "4", "5"]
+    assert len(rows) == 6 and len({row['nick'] for row in rows}) == 6
+    assert calls['n'] == 10  # вся первая попытка откатилась до точки сохранения и повторилась
+
+
+def test_savepoint_keeps_earlier_work_in_the_transaction(run_db, monkeypatch):
+    allocate = main.nick_allocator.allocate
+    calls = {'n': 0}
+
+    def conflicting_allocate(db, chat_id, theme):
+        calls['n'] += 1
+        return "Санта01" if calls['n'] == 1 else allocate(db, chat_id, theme)
+    monkeypatch.setattr(main.nick_allocator, "allocate", conflicting_allocate)
+
+    def tx(db):
+        # Записи той же транзакции до массовой вставки не должны пропасть при откате к точке сохранения
+        db.execute("INSERT INTO games (chat_id) VALUES ('-1')")
+        db.execute("INSERT INTO players (user_id, chat_id, full_name, nick) VALUES ('1', '-1', 'a', 'Санта01')")
+        main._register_users_tx(db, "-1", [("2", "b")], "christmas")
+
+    async def scenario():
+        main.nick_allocator.forget("-1")
+        await main.storage.run(tx)
+        game = await main.storage.fetchone("SELECT 1 FROM games WHERE chat_id = '-1'")
+        players = await main.storage.fetchall("SELECT user_id FROM players WHERE chat_id = '-1' ORDER BY user_id")
+        return game is not None, [row['user_id'] for row in players]
+    assert run_db(scenario) == (True, ["1", "2"])
+    assert calls['n'] == 2
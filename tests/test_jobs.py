@@ -0,0 +1,116 @@
+import asyncio
+import datetime
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Chat, Message, User
+
+import main
+
+
+async def add_job(job_id="draw:-1", run_at=100):
+    await main.storage.execute(
+        "INSERT INTO scheduled_jobs (job_id, kind, chat_id, run_at) VALUES (?, 'draw', '-1', ?)", (job_id, run_at)
+    )
+
+
+async def job_row(job_id="draw:-1"):
+    return await main.storage.fetchone("SELECT status, attempts, error FROM scheduled_jobs WHERE job_id = ?", (job_id,))
+
+
+def test_job_runs_once_under_concurrent_triggers(run_db, monkeypatch):
+    calls = []
+
+    async def fake_draw(chat_id):
+        calls.append(chat_id)
+        await asyncio.sleep(0.01)
+    monkeypatch.setattr(main, "do_draw", fake_draw)
+
+    async def scenario():
+        await add_job()
+        await asyncio.gather(*[main.run_game_job("draw", "-1", 100) for _ in range(5)])
+        await main.run_game_job("draw", "-1", 100)
+        return await job_row()
+    row = run_db(scenario)
+    assert calls == ["-1"]
+    assert (row["status"], row["attempts"]) == ("done", 1)
+
+
+def test_failed_job_is_not_retried(run_db, monkeypatch):
+    calls = []
+
+    async def failing_draw(chat_id):
+        calls.append(chat_id)
+        raise RuntimeError("429")
+    monkeypatch.setattr(main, "do_draw", failing_draw)
+
+    async def scenario():
+        await add_job()
+        await main.run_game_job("draw", "-1", 100)
+        await main.run_game_job("draw", "-1", 100)
+        return await job_row()
+    row = run_db(scenario)
+    assert calls == ["-1"]
+    assert row["status"] == "failed" and "429" in row["error"]
+
+
+def test_interrupted_jobs_are_retried_up_to_the_cap(run_db):
+    async def scenario():
+        await add_job("draw:-1")
+        await add_job("reveal:-1")
+        await main.storage.execute("UPDATE scheduled_jobs SET status = 'running', attempts = 1 WHERE job_id = 'draw:-1'")
+        await main.storage.execute(
+            "UPDATE scheduled_jobs SET status = 'running', attempts = ? WHERE job_id = 'reveal:-1'",
+            (main.JOB_MAX_ATTEMPTS,)
+        )
+        recovered = await main.storage.run(main._recover_running_jobs_tx, main.JOB_MAX_ATTEMPTS)
+        return recovered, (await job_row("draw:-1"))["status"], (await job_row("reveal:-1"))["status"]
+    assert run_db(scenario) == ((1, 1), "pending", "failed")
+
+
+def test_job_lag_uses_scheduler_wall_clock(run_db, monkeypatch):
+    # run_at хранит "настенное" время планировщика, а не UTC-момент
+    run_at = int(main.datetime(2026, 12, 24, 20, 0).timestamp())
+    monkeypatch.setattr(main, "_scheduler_now", lambda: main.datetime(2026, 12, 24, 20, 1, 30))
+    observed = {}
+    monkeypatch.setattr(main.metrics, "observe", lambda name, labels, value: observed.setdefault(name, value))
+
+    async def fake_draw(chat_id):
+        pass
+    monkeypatch.setattr(main, "do_draw", fake_draw)
+
+    async def scenario():
+        await add_job(run_at=run_at)
+        await main.run_game_job("draw", "-1", run_at)
+    run_db(scenario)
+    assert observed["santa_job_lag_seconds"] == 90
+
+
+def test_setup_rejects_past_dates(run_db, monkeypatch):
+    replies = []
+
+    async def fake_request(bot, method, timeout=None):
+        replies.append(method.text)
+        return True
+    monkeypatch.setattr(main.bot.session, "make_request", fake_request)
+
+    def typed(text):
+        return Message(
+            message_id=1, date=datetime.datetime.now(), text=text,
+            chat=Chat(id=-1, type="supergroup"), from_user=User(id=1, is_bot=False, first_name="u"),
+        ).as_(main.bot)
+
+    async def scenario():
+        await main.storage.execute("INSERT INTO games (chat_id) VALUES ('-1')")
+        state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=-1, user_id=1))
+        past = (main._scheduler_now() - datetime.timedelta(days=365)).strftime("%d.%m.%Y %H:%M")
+        await main.set_draw(typed(past), state)
+        await main.set_reveal(typed(past), state)
+        jobs = await main.storage.fetchall("SELECT job_id FROM scheduled_jobs")
+        game = await main.storage.fetchone("SELECT draw_time, end_time FROM games WHERE chat_id = '-1'")
+        return jobs, tuple(game)
+    jobs, game = run_db(scenario)
+    invalid = main.get_text('invalid_date', 'ru')
+    assert replies == [invalid, invalid]
+    assert jobs == [] and game == (None, None)
@@ -0,0 +1,55 @@
+import asyncio
+import random
+import re
+
+import main
+
+
+def parse(text):
+    """[(ник, очки)] из текста таблицы лидеров"""
+    return [(nick, int(score)) for nick, score in re.findall(r"^\d+\. (.+) — (\d+) очков$", text, re.M)]
+
+
+def test_incremental_top_matches_the_database(run_db, monkeypatch):
+    monkeypatch.setattr(main, "score_buffer", main.ScoreBuffer(max_events=10 ** 9))
+    cache = main.LeaderboardCache(size=10)
+    rnd = random.Random(7)
+    players = [str(i) for i in range(1, 31)]
+
+    def guesses(count):
+        for _ in range(count):
+            # Скос к первым игрокам, чтобы топ менялся, а не стоял на месте
+            user_id = players[min(int(rnd.expovariate(0.15)), len(players) - 1)]
+            main.score_buffer.add("-1", user_id)
+            cache.record("-1", user_id)
+
+    async def scenario():
+        await main.storage.execute("INSERT INTO games (chat_id) VALUES ('-1')")
+        await main.register_users("-1", [(user_id, f"u{user_id}") for user_id in players])
+        # Холодный кэш: часть очков уже в базе, часть ещё в буфере
+        guesses(300)
+        await main.score_buffer.flush()
+        guesses(200)
+        # Прогрев идёт, пока приходят новые очки и буфер сбрасывается параллельно
+        warming = asyncio.create_task(cache.get("-1"))
+        while "-1" not in cache._loading:
+            await asyncio.sleep(0)
+        guesses(150)
+        flushing = asyncio.create_task(main.score_buffer.flush())
+        guesses(50)
+        await asyncio.gather(warming, flushing)
+        # Тёплый кэш: инкрементальные поправки топа
+        guesses(500)
+        await main.score_buffer.flush()
+        text = await cache.render("-1", "ru")
+        rows = await main.storage.fetchall(
+            "SELECT nick, score FROM players WHERE chat_id = '-1' ORDER BY score DESC LIMIT 10"
+        )
+        everyone = await main.storage.fetchall("SELECT nick, score FROM players WHERE chat_id = '-1'")
+        return text, [(row['nick'], row['score']) for row in rows], {row['nick']: row['score'] for row in everyone}
+    text, expected, scores = run_db(scenario)
+    board = parse(text)
+    assert len(board) == 10
+    # При равных очках порядок в базе не определён — сравниваем очки по местам и очки каждого ника
+    assert [score for _, score in board] == [score for _, score in expected]
+    assert all(scores[nick] == score for nick, score in board)
@@ -0,0 +1,8 @@
+import main
+
+
+def test_label_values_are_escaped():
+    metrics = main.Metrics()
+    metrics.counter("santa_test_total", "Проверка меток")
+    metrics.inc("santa_test_total", (('handler', 'a"b\\c\nd'),))
+    assert 'santa_test_total{handler="a\\"b\\\\c\\nd"} 1' in metrics.render().splitlines()
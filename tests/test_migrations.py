@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+import main
+
+# Горячие запросы к players и индекс, который должен их покрывать целиком
+HOT_QUERIES = [
+    # LeaderboardCache и NickRoster грузят чат целиком
+    ("SELECT user_id, nick, score FROM players WHERE chat_id = ?", "idx_players_chat_score"),
+    ("SELECT user_id, nick FROM players WHERE chat_id = ?", "idx_players_chat_score"),
+    ("SELECT nick, score FROM players WHERE chat_id = ? ORDER BY score DESC LIMIT 10", "idx_players_chat_score"),
+    # Пул ников NickAllocator и проверка уникальности ника
+    ("SELECT nick FROM players WHERE chat_id = ?", "idx_players_chat_nick"),
+    ("SELECT 1 FROM players WHERE chat_id = ? AND nick = ?", "idx_players_chat_nick"),
+    # Занятость премиум-ника в /premium и success_pay
+    ("SELECT 1 FROM players WHERE premium_nick = ? AND chat_id = ?", "idx_players_chat_premium"),
+]
+
+
+@pytest.fixture
+def schema(run_db):
+    async def scenario():
+        return main.storage.path
+    path = run_db(scenario)
+    db = sqlite3.connect(path)
+    yield db
+    db.close()
+
+
+def test_all_migrations_applied(schema):
+    version = schema.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+    assert version == main.MIGRATIONS[-1][0]
+
+
+def test_migration_versions_are_ordered():
+    versions = [version for version, _, _ in main.MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
+
+
+@pytest.mark.parametrize("sql, index", HOT_QUERIES)
+def test_hot_queries_use_covering_indexes(schema, sql, index):
+    plan = [row[3] for row in schema.execute("EXPLAIN QUERY PLAN " + sql, ("x",) * sql.count("?"))]
+    assert len(plan) == 1, plan
+    assert plan[0].startswith(f"SEARCH players USING COVERING INDEX {index} ("), plan
+
+
+def test_migrations_upgrade_legacy_database(tmp_path, run_db):
+    # База из версии без schema_version: ачивки без чата. run_db открывает тот же tmp_path/santa.db
+    legacy = tmp_path / "santa.db"
+    db = sqlite3.connect(legacy)
+    main._migrate_base_schema(db)
+    db.execute("INSERT INTO players (user_id, chat_id, nick) VALUES ('1', '-1', 'a'), ('1', '-2', 'b')")
+    db.execute("INSERT INTO achievements (player_id, name) VALUES ('1', 'x')")
+    db.commit()
+    db.close()
+
+    async def scenario():
+        return await main.storage.fetchall("SELECT chat_id FROM achievements WHERE player_id = '1' ORDER BY chat_id")
+    rows = run_db(scenario)
+    assert [row["chat_id"] for row in rows] == ["-1", "-2"]
@@ -0,0 +1,73 @@
+import sqlite3
+
+import main
+
+PREFIXES = main.NICK_PREFIXES['christmas']
+BASE_SPACE = len(PREFIXES) * 98  # суффиксы 01..98
+
+
+def players_db():
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE players (user_id TEXT, chat_id TEXT, full_name TEXT, nick TEXT, PRIMARY KEY (user_id, chat_id))")
+    db.execute("CREATE UNIQUE INDEX idx_players_chat_nick ON players (chat_id, nick)")
+    return db
+
+
+def test_nicks_stay_unique_past_the_two_digit_space():
+    allocator = main.NickAllocator()
+    db = players_db()
+    nicks = [allocator.allocate(db, "-1", "christmas") for _ in range(BASE_SPACE + 500)]
+    assert BASE_SPACE == 784
+    assert len(set(nicks)) == len(nicks)
+    two_digit = {prefix + str(i).zfill(2) for prefix in PREFIXES for i in range(1, 99)}
+    # Сначала выдаётся всё двузначное пространство, и только потом трёхзначные суффиксы
+    assert set(nicks[:BASE_SPACE]) == two_digit
+    for nick in nicks[BASE_SPACE:]:
+        suffix = nick[-3:]
+        assert suffix.isdigit() and 100 <= int(suffix) <= 999 and nick[:-3] in PREFIXES
+
+
+def test_nicks_skip_ones_already_in_the_database():
+    allocator = main.NickAllocator()
+    db = players_db()
+    taken = {prefix + "01" for prefix in PREFIXES}
+    db.executemany("INSERT INTO players (user_id, chat_id, nick) VALUES (?, '-1', ?)", enumerate(taken))
+    nicks = {allocator.allocate(db, "-1", "christmas") for _ in range(BASE_SPACE - len(taken))}
+    assert not nicks & taken
+
+
+def test_theme_switch_reloads_the_pool():
+    allocator = main.NickAllocator()
+    db = players_db()
+    first = allocator.allocate(db, "-1", "christmas")
+    db.execute("INSERT INTO players (user_id, chat_id, nick) VALUES ('1', '-1', ?)", (first,))
+    nick = allocator.allocate(db, "-1", "halloween")
+    assert nick[:-2] in main.NICK_PREFIXES['halloween']
+    assert allocator._pools["-1"]['used'] == {first, nick}
+
+
+def test_pools_are_bounded():
+    allocator = main.NickAllocator(maxsize=10)
+    db = players_db()
+    for chat in range(50):
+        allocator.allocate(db, str(-chat), "christmas")
+    assert len(allocator._pools) == 10
+
+
+def test_retry_after_integrity_error_gives_a_unique_nick(run_db):
+    async def scenario():
+        main.nick_allocator.forget("-1")  # пул мог остаться от базы другого теста
+        await main.register_user("1", "-1", "first")
+        # Следующий ник пула занимают в обход аллокатора (другой процесс)
+        pool = main.nick_allocator._pools["-1"]
+        index = (pool['offset'] + pool['cursor'] * pool['stride']) % pool['size']
+        stolen = main.NickAllocator._candidate(pool, index)
+        await main.storage.execute(
+            "INSERT INTO players (user_id, chat_id, full_name, nick) VALUES ('2', '-1', 'other', ?)", (stolen,)
+        )
+        nick = await main.register_user("3", "-1", "third")
+        rows = await main.storage.fetchall("SELECT nick FROM players WHERE chat_id = '-1'")
+        return stolen, nick, [row['nick'] for row in rows]
+    stolen, nick, nicks = run_db(scenario)
+    assert nick is not None and nick != stolen
+    assert len(nicks) == 3 and len(set(nicks)) == 3
@@ -0,0 +1,42 @@
+import queue
+
+import main
+
+
+def message(chat, **extra):
+    return {"update_id": 1, "message": {"message_id": 1, "date": 1, "chat": chat,
+                                        "from": {"id": 7, "is_bot": False, "first_name": "u"}, **extra}}
+
+
+GROUP = {"id": -1001234567890, "type": "supergroup", "title": "g"}
+PRIVATE = {"id": 7, "type": "private", "first_name": "u"}
+
+
+def test_premium_payment_routes_to_group_shard():
+    payment = {"currency": "XTR", "total_amount": 50, "invoice_payload": f"premium_Снежная_Королева_{GROUP['id']}",
+               "telegram_payment_charge_id": "c", "provider_payment_charge_id": "p"}
+    assert main.update_chat_id(message(PRIVATE, successful_payment=payment)) == GROUP["id"]
+
+    queues = [queue.SimpleQueue() for _ in range(8)]
+    router = main.ShardRouter(queues)
+    router.route(message(GROUP, text="hi"))
+    router.route(message(PRIVATE, successful_payment=payment))
+    owner = main.shard_of(GROUP["id"], 8)
+    assert queues[owner].qsize() == 2
+
+
+def test_other_payments_route_by_chat():
+    payment = {"currency": "XTR", "total_amount": 10, "invoice_payload": "donation",
+               "telegram_payment_charge_id": "c", "provider_payment_charge_id": "p"}
+    assert main.update_chat_id(message(PRIVATE, successful_payment=payment)) == PRIVATE["id"]
+
+
+def test_parse_premium_payload():
+    assert main.parse_premium_payload("premium_Баба_Яга_-100") == ("Баба_Яга", "-100")
+    assert main.parse_premium_payload("donation") is None
+
+
+def test_callback_without_message_routes_by_user():
+    update = {"update_id": 1, "callback_query": {"id": "1", "chat_instance": "x", "data": "d",
+                                                 "from": {"id": 42, "is_bot": False, "first_name": "u"}}}
+    assert main.update_chat_id(update) == 42
@@ -0,0 +1,83 @@
+import asyncio
+import datetime
+
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+import main
+
+
+def command(text, user_id=1, chat_id=-1):
+    return Message(
+        message_id=1, date=datetime.datetime.now(), text=text,
+        chat=Chat(id=chat_id, type="supergroup"), from_user=User(id=user_id, is_bot=False, first_name="u"),
+    )
+
+
+def feed(middleware, texts, **kwargs):
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.text)
+
+    async def run():
+        for text in texts:
+            await middleware(handler, command(text, **kwargs), {})
+    asyncio.run(run())
+    return handled
+
+
+def test_made_up_commands_share_the_default_bucket():
+    middleware = main.ThrottlingMiddleware(main.THROTTLE_LIMITS)
+    burst = main.THROTTLE_LIMITS['default'][1]
+    handled = feed(middleware, [f"/fake{i}" for i in range(burst * 4)])
+    assert len(handled) == burst
+    assert set(middleware.dropped) == {'default'}
+
+
+def test_registered_commands_keep_their_scope():
+    middleware = main.ThrottlingMiddleware(main.THROTTLE_LIMITS)
+    assert middleware._scope(command("/leaderboard@santa_bot"), {}) == 'leaderboard'
+    assert middleware._scope(command("/mygift wish"), {}) == 'mygift'
+    assert middleware._scope(command("/nonsense"), {}) == 'default'
+    assert middleware._scope(command("hello"), {}) is None
+
+
+def test_limited_command_drops_after_burst():
+    middleware = main.ThrottlingMiddleware(main.THROTTLE_LIMITS)
+    burst = main.THROTTLE_LIMITS['leaderboard'][1]
+    assert len(feed(middleware, ["/leaderboard"] * (burst + 3), user_id=2)) == burst
+
+
+def test_every_player_pressing_join_once_gets_through():
+    middleware = main.ThrottlingMiddleware(main.THROTTLE_LIMITS)
+    players = 500
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.from_user.id)
+
+    async def run():
+        for user_id in range(1, players + 1):
+            press = CallbackQuery(
+                id=str(user_id), from_user=User(id=user_id, is_bot=False, first_name="u"), chat_instance="c",
+                message=command("🎄", user_id=0), data=main.pack_callback(main.CB_JOIN),
+            )
+            await middleware(handler, press, {'cb': (main.CB_JOIN,)})
+    asyncio.run(run())
+    assert len(handled) == players
+    assert middleware.dropped == {}
+
+
+def test_expensive_command_keeps_chat_limit():
+    middleware = main.ThrottlingMiddleware(main.THROTTLE_LIMITS)
+    chat_burst = main.THROTTLE_LIMITS['leaderboard'][3]
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.from_user.id)
+
+    async def run():
+        for user_id in range(1, chat_burst * 3):
+            await middleware(handler, command("/leaderboard", user_id=user_id), {})
+    asyncio.run(run())
+    assert len(handled) == chat_burst
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+
+
+class FakeTelegram:
+    """Подмена Bot API на уровне сессии aiogram: записывает вызовы, отвечает с задержкой"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+
+    async def __call__(self, bot, method, timeout=None):
+        await asyncio.sleep(self.latency)
+        self.calls.append((type(method).__name__, getattr(method, "text", None), time.monotonic()))
+        return True
+
+    async def wait_for(self, name, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for call in self.calls:
+                if call[0] == name:
+                    return call
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"{name} не был вызван: {self.calls}")
+
+
+def start_update(update_id, user_id=100):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 1, "text": "/start",
+            "chat": {"id": user_id, "type": "private", "first_name": "u"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+def webhook(run_db, monkeypatch, latency, scenario):
+    fake = FakeTelegram(latency)
+    monkeypatch.setattr(main.bot.session, "make_request", fake)
+
+    async def wrapper():
+        client = TestClient(TestServer(main.build_webhook_app()))
+        await client.start_server()
+        try:
+            return await scenario(client, fake)
+        finally:
+            await client.close()
+    return run_db(wrapper)
+
+
+def test_rejects_wrong_secret(run_db, monkeypatch):
+    async def scenario(client, fake):
+        response = await client.post(
+            main.WEBHOOK_PATH, json=start_update(1), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+        )
+        await asyncio.sleep(0.1)
+        return response.status, fake.calls
+    status, calls = webhook(run_db, monkeypatch, 0, scenario)
+    assert status == 401
+    assert calls == []
+
+
+def test_acknowledges_before_handling(run_db, monkeypatch):
+    async def scenario(client, fake):
+        started = time.monotonic()
+        response = await client.post(
+            main.WEBHOOK_PATH, json=start_update(2, user_id=101),
+            headers={"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET}
+        )
+        acked = time.monotonic()
+        name, text, sent_at = await fake.wait_for("SendMessage")
+        return response.status, acked - started, sent_at - started, text
+    status, ack_delay, send_delay, text = webhook(run_db, monkeypatch, 0.3, scenario)
+    assert status == 200
+    # Ответ Telegram уходит сразу, медленный Bot API обрабатывается в фоне
+    assert ack_delay < 0.2 < send_delay
+    assert text == main.get_text("start", "ru")
+
+
+def test_healthcheck(run_db, monkeypatch):
+    async def scenario(client, fake):
+        response = await client.get("/healthz")
+        return response.status, await response.text()
+    assert webhook(run_db, monkeypatch, 0, scenario) == (200, "ok")